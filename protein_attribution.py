@@ -0,0 +1,76 @@
+#attribution of the predicted structures to the input channels of every residue, for whole proteins of a dataset.
+#the score of a structure is its logit summed over all residues of the protein, so the attribution of a residue and
+#channel says how much that input pushed the protein's residues towards C, E or H. the results are written to disk as
+#they are computed:
+#    attributions.npy  float16 (total residues, 3 structures, 21 channels), rows of a protein follow each other
+#    offsets.npy       int64, rows offsets[i]:offsets[i + 1] belong to protein i
+#    ids.txt           protein ids in the same order
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from protein_data import structure_seq, input_channels, build_inputs, protein_lengths, loader_options, dataset_protein_ids
+
+#the padded model input of a batch and a mask of the real residues, labels are ignored so the train and the test
+#dataset can both be used
+def collate_inputs(batch):
+    lengths = torch.tensor([len(item[0]) for item in batch])
+    mask = torch.arange(int(lengths.max()))[None, :] < lengths[:, None]
+    return build_inputs([item[0] for item in batch], [item[1] for item in batch]), mask
+
+#score of each structure for each protein, the logits of the real residues summed up, (batch, 3)
+def structure_scores(x, mask, model):
+    return model(x, mask).masked_fill(~mask.unsqueeze(1), 0).sum(2)
+
+#compute the attributions of every protein of the dataset and stream them into out_dir.
+#method 'ig' is IntegratedGradients with n_steps steps from an all-zero input, the steps are run internal_batch_size
+#inputs at a time. 'grad_input' is gradient * input, one backward pass per batch, for large runs.
+#DeepLift is not offered: it replaces the backward pass of every relu module and needs one module per activation,
+#ProteinCNN uses the same relu module after all three convolutions.
+#the three structures are attributed in one call, the batch is repeated once for each of them
+def attribute_dataset(model, dataset, out_dir, method='ig', batch_size=8, n_steps=50, internal_batch_size=64, loader_kwargs=None):
+    #captum is only needed here, importing this module does not load it
+    from captum.attr import InputXGradient, IntegratedGradients
+    model.eval()
+    forward = lambda x, mask: structure_scores(x, mask, model)
+    attribution = IntegratedGradients(forward) if method == 'ig' else InputXGradient(forward)
+    lengths = protein_lengths(dataset)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    os.makedirs(out_dir, exist_ok=True)
+    store = np.lib.format.open_memmap(os.path.join(out_dir, 'attributions.npy'), mode='w+', dtype=np.float16,
+                                      shape=(int(offsets[-1]), len(structure_seq), input_channels))
+    loader = DataLoader(dataset, batch_size, shuffle=False, collate_fn=collate_inputs, **(loader_kwargs or loader_options()))
+    n_classes = len(structure_seq)
+    protein = 0
+    for x, mask in loader:
+        targets = torch.arange(n_classes).repeat_interleave(len(x)).tolist()
+        inputs, masks = x.repeat(n_classes, 1, 1), mask.repeat(n_classes, 1)
+        if method == 'ig':
+            attr = attribution.attribute(inputs, target=targets, additional_forward_args=(masks,), n_steps=n_steps,
+                                         internal_batch_size=internal_batch_size)
+        else:
+            attr = attribution.attribute(inputs, target=targets, additional_forward_args=(masks,))
+        #(3 * batch, 21, residues) -> (batch, residues, 3, 21)
+        attr = attr.detach().view(n_classes, len(x), x.shape[1], x.shape[2]).permute(1, 3, 0, 2)
+        for i, length in enumerate(mask.sum(1).tolist()):
+            store[offsets[protein]:offsets[protein + 1]] = attr[i, :length].numpy()
+            protein += 1
+    store.flush()
+    del store
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(out_dir, 'ids.txt'), 'w') as file:
+        file.write('\n'.join(dataset_protein_ids(dataset)) + '\n')
+    return load_attributions(out_dir)
+
+#open the attributions written by attribute_dataset, returns the memory-mapped array, the offsets and the protein ids
+def load_attributions(out_dir):
+    attributions = np.load(os.path.join(out_dir, 'attributions.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(out_dir, 'offsets.npy'))
+    with open(os.path.join(out_dir, 'ids.txt')) as file:
+        ids = file.read().split()
+    return attributions, offsets, ids
@@ -0,0 +1,228 @@
+#benchmark suite on synthetic proteins, so performance can be measured and compared without the real data.
+#the generator writes the same csv layout as the assignment data (a <id>_train.csv / <id>_test.csv per protein with
+#RES_NUM, AMINO_ACID and 20 pssm columns, labels_train.csv with PDB_ID,SEC_STRUCT and seqs_test.csv), then every stage
+#is timed at each dataset size and batch size and the results are written as a json report. before the timing, the
+#exactness checks of the pipeline run on the same data (exits with 1 if one fails, --skip-checks leaves them out).
+#
+#    python protein_benchmark.py --out report.json
+#    python protein_benchmark.py --out new.json --compare report.json   (exits with 1 if a stage got slower)
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from protein_data import ProteinDataset, acid_seq, structure_seq, collate_fn, collate_fn2, collate_packed, build_inputs
+from protein_predict import evaluation, iter_window_predictions
+from protein_train import build_model, train_loop, val_pred
+
+#write n_train labelled and n_test unlabelled random proteins into root. lengths follow a lognormal distribution with
+#the given median, clipped to [min_length, max_length], pssm values are normal with pssm_scale as standard deviation
+#(rounded like the real profiles) and labels are drawn with the probabilities in label_mix (C, E, H)
+def make_synthetic_proteins(root, n_train, n_test=0, median_length=200, min_length=30, max_length=1000, pssm_scale=3.0,
+                            label_mix=(0.45, 0.2, 0.35), seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, 'train'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'test'), exist_ok=True)
+    labels, seqs = [], []
+    for split, n in (('train', n_train), ('test', n_test)):
+        lengths = np.clip(rng.lognormal(np.log(median_length), 0.5, n).astype(int), min_length, max_length)
+        for i, length in enumerate(lengths):
+            protein_id = f'SYN{split[:2].upper()}{i:06d}'
+            sequence = ''.join(rng.choice(list(acid_seq), length))
+            df = pd.DataFrame({'RES_NUM': np.arange(1, length + 1), 'AMINO_ACID': list(sequence)})
+            for acid, column in zip(acid_seq, rng.normal(scale=pssm_scale, size=(len(acid_seq), length)).round()):
+                df[acid] = column
+            df.to_csv(os.path.join(root, split, f'{protein_id}_{split}.csv'), index=False)
+            if split == 'train':
+                labels.append((protein_id, ''.join(rng.choice(list(structure_seq), length, p=label_mix))))
+            else:
+                seqs.append((protein_id, sequence))
+    pd.DataFrame(labels, columns=['PDB_ID', 'SEC_STRUCT']).to_csv(os.path.join(root, 'labels_train.csv'), index=False)
+    pd.DataFrame(seqs, columns=['PDB_ID', 'SEQUENCE']).to_csv(os.path.join(root, 'seqs_test.csv'), index=False)
+
+#best and median wall time of repeats calls of fn
+def time_call(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+def result(stage, size, batch_size, times, proteins, residues):
+    best, median = times
+    return {'stage': stage, 'size': size, 'batch_size': batch_size, 'best_s': best, 'median_s': median,
+            'proteins_per_s': proteins / best, 'residues_per_s': residues / best}
+
+#the labelled proteins collated like the test set, for timing evaluation
+def collate_unlabelled(batch):
+    return collate_fn2([item[:2] for item in batch])
+
+#time every stage at each dataset size (the first size proteins of the synthetic set) and batch size. item loading is
+#timed from the csv files and from the memory mapped store, the other stages use the store
+def run_benchmarks(root, sizes, batch_sizes, repeats=3, seed=0):
+    csv_dataset = ProteinDataset(os.path.join(root, 'train'), os.path.join(root, 'labels_train.csv'))
+    store_dataset = ProteinDataset(os.path.join(root, 'train'), os.path.join(root, 'labels_train.csv'),
+                                   store_path=os.path.join(root, 'train_store'))
+    parameters = {'lr': 0.001, 'dropout_rate': 0.1, 'batch_size': batch_sizes[0]}
+    loss_fn = torch.nn.CrossEntropyLoss()
+    results = []
+    for size in sizes:
+        indices = list(range(size))
+        residues = int(sum(len(store_dataset[i][0]) for i in indices))
+        for name, dataset in (('load_csv', csv_dataset), ('load_store', store_dataset)):
+            times = time_call(lambda: [dataset[i] for i in indices], repeats)
+            results.append(result(name, size, None, times, size, residues))
+        items = [store_dataset[i] for i in indices]
+        train_set = Subset(store_dataset, indices)
+        for batch_size in batch_sizes:
+            batches = [items[i:i + batch_size] for i in range(0, size, batch_size)]
+            times = time_call(lambda: [collate_fn(batch) for batch in batches], repeats)
+            results.append(result('collate', size, batch_size, times, size, residues))
+
+            torch.manual_seed(seed)
+            model = build_model(parameters)
+            optimizer = torch.optim.Adam(model.parameters(), parameters['lr'])
+            train_loader = DataLoader(train_set, batch_size, shuffle=True, collate_fn=collate_fn,
+                                      generator=torch.Generator().manual_seed(seed))
+            loader = DataLoader(train_set, batch_size, shuffle=False, collate_fn=collate_fn)
+            test_loader = DataLoader(train_set, batch_size, shuffle=False, collate_fn=collate_unlabelled)
+            #the training and validation loops print their progress, the report is all that is needed here
+            with contextlib.redirect_stdout(io.StringIO()):
+                times = time_call(lambda: train_loop(model, train_loader, loader, optimizer, loss_fn, 1, 1, 'benchmark'), repeats)
+                results.append(result('train_epoch', size, batch_size, times, size, residues))
+                times = time_call(lambda: val_pred(model, loader, loss_fn), repeats)
+                results.append(result('val_pred', size, batch_size, times, size, residues))
+            times = time_call(lambda: evaluation(model, test_loader), repeats)
+            results.append(result('evaluation', size, batch_size, times, size, residues))
+    return results
+
+#the networks the exactness checks run on: the original one and a deeper, separable, dilated one
+check_architectures = ({}, {'depth': 4, 'separable': True, 'dilation': 2})
+
+#untrained models of check_architectures in evaluation mode, random weights are enough for the checks
+def check_models(seed=0):
+    torch.manual_seed(seed)
+    return [build_model({'dropout_rate': 0.1, **architecture}).eval() for architecture in check_architectures]
+
+#the logits of a protein on its own, (3, residues)
+def single_logits(model, sequence, pssm):
+    with torch.no_grad():
+        return model(build_inputs([sequence], [pssm]))[0]
+
+#packed mode has to give every protein exactly the logits it gets on its own: the gap of model.pack_gap residues and
+#the mask keep the proteins of a packed batch apart. returns the largest difference over the first n_proteins proteins
+#for each architecture, float32 rounding only (about 1e-6)
+def check_packed(dataset, n_proteins=16):
+    items = [dataset[i] for i in range(min(n_proteins, len(dataset)))]
+    differences = []
+    for model in check_models():
+        x, _, mask, lengths = collate_packed(items, model.pack_gap)
+        with torch.no_grad():
+            packed = model(x, mask)[0][:, mask[0]].split(lengths.tolist(), dim=1)
+        differences.append(max(float((logits - single_logits(model, item[0], item[1])).abs().max())
+                               for logits, item in zip(packed, items)))
+    return differences
+
+#windowed prediction has to give every residue the structure predicted from the whole protein, since each window gets
+#receptive_radius residues of context. the proteins are cut into windows of window residues (small, so most proteins
+#have several) and predicted batch_windows at a time, with each architecture and with its int8 quantized model (as
+#predict --quantized --window does). returns the number of residues that differ for each of these models
+def check_windows(dataset, n_proteins=16, window=48, batch_windows=5):
+    from protein_quant import quantize_model, calibration_loader
+    subset = Subset(dataset, list(range(min(n_proteins, len(dataset)))))
+    models = check_models()
+    models += [quantize_model(model, calibration_loader(dataset, n_proteins=64)) for model in models]
+    mismatches = []
+    for model in models:
+        whole = [single_logits(model, item[0], item[1]).argmax(0).numpy() for item in subset]
+        windowed = iter_window_predictions(model, subset, window, batch_windows)
+        mismatches.append(int(sum((a != b).sum() for a, b in zip(whole, windowed))))
+    return mismatches
+
+#stages of report that are slower than in baseline by more than tolerance (a fraction of the baseline time)
+def find_regressions(report, baseline, tolerance=0.2):
+    key = lambda entry: (entry['stage'], entry['size'], entry['batch_size'])
+    baseline_times = {key(entry): entry['best_s'] for entry in baseline['results']}
+    return [dict(entry, baseline_s=baseline_times[key(entry)]) for entry in report['results']
+            if key(entry) in baseline_times and entry['best_s'] > baseline_times[key(entry)] * (1 + tolerance)]
+
+#run the exactness checks on the synthetic training proteins in root, {name: {'values': ..., 'passed': ...}}
+def run_checks(root):
+    dataset = ProteinDataset(os.path.join(root, 'train'), os.path.join(root, 'labels_train.csv'),
+                             store_path=os.path.join(root, 'train_store'))
+    differences = check_packed(dataset)
+    mismatches = check_windows(dataset)
+    return {'packed_logits': {'values': differences, 'passed': max(differences) < 1e-4},
+            'window_predictions': {'values': mismatches, 'passed': max(mismatches) == 0}}
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the protein pipeline on synthetic data')
+    parser.add_argument('--out', default='benchmark_report.json', help='json report to write')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256], help='numbers of proteins')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--median-length', type=int, default=200)
+    parser.add_argument('--max-length', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='keep the synthetic data here instead of a temporary folder')
+    parser.add_argument('--compare', help='baseline report, stages more than --tolerance slower are listed')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--skip-checks', action='store_true', help='leave out the exactness checks')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        root = args.data_dir or temporary
+        if not os.path.exists(os.path.join(root, 'labels_train.csv')):
+            make_synthetic_proteins(root, max(args.sizes), median_length=args.median_length, max_length=args.max_length,
+                                    seed=args.seed)
+        #a kept data folder has to hold enough proteins for the largest size
+        n_proteins = sum(file_name.endswith('_train.csv') for file_name in os.listdir(os.path.join(root, 'train')))
+        if n_proteins < max(args.sizes):
+            sys.exit(f'{root} has {n_proteins} training proteins, fewer than the largest size {max(args.sizes)}: '
+                     f'use another --data-dir or smaller --sizes')
+        checks = {} if args.skip_checks else run_checks(root)
+        torch.manual_seed(args.seed)
+        results = run_benchmarks(root, args.sizes, args.batch_sizes, args.repeats, args.seed)
+
+    report = {
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                        'machine': platform.machine(), 'processor': platform.processor()},
+        'checks': checks,
+        'results': results,
+    }
+    with open(args.out, 'w') as file:
+        json.dump(report, file, indent=2)
+    for entry in results:
+        print(f"{entry['stage']:12s} size {entry['size']:6d} batch {str(entry['batch_size']):>4s}: "
+              f"{entry['best_s'] * 1000:9.2f} ms, {entry['residues_per_s']:12.0f} residues/s")
+
+    failed = [name for name, check in checks.items() if not check['passed']]
+    for name, check in checks.items():
+        print(f"check {name}: {'passed' if check['passed'] else 'FAILED'}, {check['values']}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = find_regressions(report, json.load(file), args.tolerance)
+        for entry in regressions:
+            print(f"slower: {entry['stage']} size {entry['size']} batch {entry['batch_size']}: "
+                  f"{entry['best_s'] * 1000:.2f} ms, baseline {entry['baseline_s'] * 1000:.2f} ms")
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+#dataset, batching and data loading for the protein secondary structure model, kept free of the notebook's
+#side effects so DataLoader worker processes can import it
+
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import ConcatDataset, Dataset, Sampler, Subset
+
+#amino acid letters in the order of their numerical values, starting from 0
+acid_seq = "ACDEFGHIKLMNPQRSTVWY"
+#byte lookup table so a whole sequence can be converted to indices in one numpy call, unknown letters map to 255
+acid_lookup = np.full(256, 255, dtype=np.uint8)
+acid_lookup[np.frombuffer(acid_seq.encode('ascii'), dtype=np.uint8)] = np.arange(len(acid_seq), dtype=np.uint8)
+
+#names of the secondary structures in the order of their numerical values
+structure_seq = "CEH"
+structure_lookup = np.full(256, 255, dtype=np.uint8)
+structure_lookup[np.frombuffer(structure_seq.encode('ascii'), dtype=np.uint8)] = np.arange(len(structure_seq), dtype=np.uint8)
+
+#convert the AMINO_ACID column of one protein file into a uint8 array of acid indices
+def encode_residues(amino_acids, protein_id):
+    letters = ''.join(amino_acids)
+    codes = acid_lookup[np.frombuffer(letters.encode('ascii'), dtype=np.uint8)]
+    if len(codes) != len(amino_acids) or (codes == 255).any():
+        raise ValueError(f'unknown amino acid in protein {protein_id}')
+    return codes
+
+#convert the SEC_STRUCT string of one protein into a uint8 array of structure indices
+def encode_structures(sec_struct, protein_id):
+    codes = structure_lookup[np.frombuffer(sec_struct.encode('ascii'), dtype=np.uint8)]
+    if (codes == 255).any():
+        raise ValueError(f'unknown secondary structure in protein {protein_id}')
+    return codes
+
+#read labels_train.csv once and encode the labels of the given proteins, returns a dict protein id -> uint8 array
+def read_labels(labels_csv_path, protein_ids):
+    sec_structs = pd.read_csv(labels_csv_path, dtype=str).set_index('PDB_ID')['SEC_STRUCT']
+    missing = [protein_id for protein_id in protein_ids if protein_id not in sec_structs.index]
+    if missing:
+        raise ValueError(f'{len(missing)} proteins have no labels in {labels_csv_path}, e.g. {missing[0]}')
+    return {protein_id: encode_structures(sec_structs[protein_id], protein_id) for protein_id in protein_ids}
+
+#labels.npy of a store: the uint8 labels of every protein back to back, at the same offsets as the residues. every
+#protein needs one label per pssm row. it is written under another name and renamed, so a store made before labels
+#were stored can get them added later without ever seeing a half written file
+def build_label_store(labels_csv_path, store_path, protein_ids, offsets):
+    labels = read_labels(labels_csv_path, protein_ids)
+    for i, protein_id in enumerate(protein_ids):
+        if len(labels[protein_id]) != offsets[i + 1] - offsets[i]:
+            raise ValueError(f'protein {protein_id} has {len(labels[protein_id])} labels but {offsets[i + 1] - offsets[i]} pssm rows')
+    with open(os.path.join(store_path, 'labels.tmp.npy'), 'wb') as file:
+        np.save(file, np.concatenate([labels[protein_id] for protein_id in protein_ids]))
+    os.replace(os.path.join(store_path, 'labels.tmp.npy'), os.path.join(store_path, 'labels.npy'))
+
+#narrow the pssm rows of a protein to pssm_dtype. float16 keeps about 3 significant digits, int8 is only allowed for
+#whole scores in -128..127 (PSI-BLAST writes whole log-odds scores), so nothing is lost
+def narrow_pssm(pssm, pssm_dtype, protein_id):
+    pssm_dtype = np.dtype(pssm_dtype)
+    if pssm_dtype == np.int8 and (np.any(pssm != np.round(pssm)) or pssm.min() < -128 or pssm.max() > 127):
+        raise ValueError(f'protein {protein_id} has pssm values that are not whole numbers in -128..127, use float16')
+    return pssm.astype(pssm_dtype)
+
+#one-time conversion of all the <id>_train.csv / <id>_test.csv files of a folder into a single packed store:
+#residues.npy holds the uint8 acid indices of every protein back to back, pssm.npy the matching PSSM rows in pssm_dtype,
+#offsets.npy the start of each protein (plus the total number of residues at the end), labels.npy the labels if a
+#labels csv is given (see build_label_store) and ids.txt the protein ids
+def build_protein_store(data_dir, suffix, store_path, protein_ids, labels_csv_path=None, pssm_dtype=np.float32):
+    residues, pssms, offsets = [], [], [0]
+    for protein_id in protein_ids:
+        df = pd.read_csv(os.path.join(data_dir, str(protein_id) + suffix))
+        residues.append(encode_residues(df['AMINO_ACID'].tolist(), protein_id))
+        pssms.append(narrow_pssm(df.iloc[:, 2:].values, pssm_dtype, protein_id))
+        offsets.append(offsets[-1] + len(df))
+
+    os.makedirs(store_path, exist_ok=True)
+    np.save(os.path.join(store_path, 'residues.npy'), np.concatenate(residues))
+    np.save(os.path.join(store_path, 'pssm.npy'), np.concatenate(pssms))
+    np.save(os.path.join(store_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    if labels_csv_path is not None:
+        build_label_store(labels_csv_path, store_path, protein_ids, offsets)
+    #ids are written last, so a store is only used once all the arrays are complete
+    with open(os.path.join(store_path, 'ids.txt'), 'w') as ids_file:
+        ids_file.write('\n'.join(str(protein_id) for protein_id in protein_ids))
+
+#why an existing store cannot serve a dataset, or None if it can. the store is rebuilt when csv files were added to or
+#removed from the folder since it was built (its ids are not the sorted manifest) or its pssm was stored in another
+#type than the one asked for
+def store_mismatch(store_path, protein_ids, pssm_dtype):
+    with open(os.path.join(store_path, 'ids.txt')) as ids_file:
+        stored_ids = ids_file.read().split('\n')
+    if stored_ids != list(protein_ids):
+        return f'it has {len(stored_ids)} proteins that do not match the {len(protein_ids)} csv files of the folder'
+    stored_dtype = np.load(os.path.join(store_path, 'pssm.npy'), mmap_mode='r').dtype
+    if stored_dtype != np.dtype(pssm_dtype):
+        return f'its pssm is {stored_dtype}, not {np.dtype(pssm_dtype)}'
+    return None
+
+#remove a store's ids.txt (so it counts as incomplete until rebuilt) and its labels, which follow its proteins
+def invalidate_store(store_path):
+    for name in ('ids.txt', 'labels.npy'):
+        if os.path.exists(os.path.join(store_path, name)):
+            os.remove(os.path.join(store_path, name))
+
+#in-process cache of decoded proteins for datasets read from the csv files, holding at most max_bytes of tensors and
+#evicting the least recently used protein first. one cache can be given to several datasets (keys include the folder)
+#and outlives the DataLoaders, so the trials of one search share it (train is another process with its own cache).
+#DataLoader worker processes get their own copy: fill it in the main process first (ProteinDataset.fill_cache) and
+#forked workers start with every protein. the hits, misses and evictions are counted in the process that reads the
+#protein, counts() and add_counts() carry them from trial worker processes back to the main process
+class TensorCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item
+
+    def put(self, key, item):
+        size = sum(tensor.numel() * tensor.element_size() for tensor in item)
+        if size > self.max_bytes or key in self.items:
+            return
+        while self.bytes + size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.bytes -= sum(tensor.numel() * tensor.element_size() for tensor in evicted)
+            self.evictions += 1
+        self.items[key] = item
+        self.bytes += size
+
+    #hits, misses and evictions, since an earlier counts() if since is given
+    def counts(self, since=None):
+        since = since or {}
+        return {name: getattr(self, name) - since.get(name, 0) for name in ('hits', 'misses', 'evictions')}
+
+    def add_counts(self, counts):
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def stats(self):
+        return {'entries': len(self.items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+#read the dataset. all paths are given explicitly and the dataset only keeps paths, ids and small arrays, so it can be
+#pickled to DataLoader worker processes; each process opens its own memory maps of the store on first use
+class ProteinDataset(Dataset):
+    def __init__(self, zip_file_path, labels_csv_path=None, store_path=None, cache=None, pssm_dtype=np.float32):
+        #set file path
+        self.zip_file_path = zip_file_path
+
+        #test if label information will be inputed
+        self.labels_available = labels_csv_path is not None
+
+        #if there is label inputed, then it should be train dataset, if no label inputed, then it should be test dataset
+        self.suffix = '_train.csv' if self.labels_available else '_test.csv'
+        #sorted manifest of the protein files, so the order is the same on every machine and in every process
+        self.protein_ids = sorted(file_name[:-len(self.suffix)] for file_name in os.listdir(self.zip_file_path)
+                                  if file_name.endswith(self.suffix))
+        #proteins are kept and returned in narrow types: uint8 residues and labels, pssm in pssm_dtype (float32, float16
+        #or int8, see narrow_pssm). a store built with another pssm type is rebuilt. the batch builders widen them
+        self.pssm_dtype = pssm_dtype
+        #without a store, proteins read from the csv files are kept in the cache (a TensorCache) if one is given
+        self.cache = cache
+        #if a store path is given, convert the csv files once and then serve every protein from the memory mapped store
+        self.store_path = store_path
+        self.residues = None
+        self.pssm = None
+        self.labels = None
+        if self.store_path is not None:
+            if os.path.exists(os.path.join(self.store_path, 'ids.txt')):
+                mismatch = store_mismatch(self.store_path, self.protein_ids, pssm_dtype)
+                if mismatch is not None:
+                    print(f'Rebuilding the store {self.store_path}, {mismatch}')
+                    invalidate_store(self.store_path)
+            if not os.path.exists(os.path.join(self.store_path, 'ids.txt')):
+                build_protein_store(self.zip_file_path, self.suffix, self.store_path, self.protein_ids, labels_csv_path, pssm_dtype)
+            with open(os.path.join(self.store_path, 'ids.txt')) as ids_file:
+                self.protein_ids = ids_file.read().split('\n')
+            self.offsets = np.load(os.path.join(self.store_path, 'offsets.npy'))
+            #a store built before the labels were stored gets them now
+            if self.labels_available and not os.path.exists(os.path.join(self.store_path, 'labels.npy')):
+                build_label_store(labels_csv_path, self.store_path, self.protein_ids, self.offsets)
+        #without a store, the labels are read and encoded once here, the length is checked when a protein is read
+        elif self.labels_available:
+            self.labels = read_labels(labels_csv_path, self.protein_ids)
+
+    #the memory maps are not pickled, every process maps the store files itself
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['residues'] = None
+        state['pssm'] = None
+        if self.store_path is not None:
+            state['labels'] = None
+        return state
+
+    def open_store(self):
+        #copy-on-write mapping, so slices can be handed to torch without copying and without read-only warnings
+        self.residues = np.load(os.path.join(self.store_path, 'residues.npy'), mmap_mode='c')
+        self.pssm = np.load(os.path.join(self.store_path, 'pssm.npy'), mmap_mode='c')
+        if self.labels_available:
+            self.labels = np.load(os.path.join(self.store_path, 'labels.npy'), mmap_mode='c')
+
+    def __len__(self):
+        return len(self.protein_ids)
+
+    def __getitem__(self, idx):
+        protein_id = self.protein_ids[idx]
+
+        #with a store, the sequence and pssm tensors are views into the memory mapped arrays
+        if self.store_path is not None:
+            if self.residues is None:
+                self.open_store()
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            sequence_tensor = torch.from_numpy(self.residues[start:end])
+            pssm_tensor = torch.from_numpy(self.pssm[start:end])
+            if self.labels_available:
+                labels = self.labels[start:end]
+        else:
+            key = (self.zip_file_path, protein_id)
+            item = self.cache.get(key) if self.cache is not None else None
+            if item is None:
+                item = self.read_protein(protein_id)
+                if self.cache is not None:
+                    self.cache.put(key, item)
+            return item
+
+        #if there is label, it should be a train dataset so return sequence tensor, pssm tensor and label tensor
+        if self.labels_available:
+            label_tensor = torch.from_numpy(labels)
+            return sequence_tensor, pssm_tensor, label_tensor
+        #if no label then only return sequence tensor and pssm tensor
+        else:
+            return sequence_tensor, pssm_tensor
+
+    #read one protein from its csv file
+    def read_protein(self, protein_id):
+        df = pd.read_csv(os.path.join(self.zip_file_path, str(protein_id) + self.suffix))
+        # Extract amino acid sequence and convert to indices
+        sequence_tensor = torch.from_numpy(encode_residues(df['AMINO_ACID'].tolist(), protein_id))
+
+          # Extract PSSM scores
+        pssm = df.iloc[:, 2:].values  # Assuming PSSM scores start from the 3rd column
+        pssm_tensor = torch.from_numpy(narrow_pssm(pssm, self.pssm_dtype, protein_id))
+        if not self.labels_available:
+            return sequence_tensor, pssm_tensor
+        labels = self.labels[protein_id]
+        if len(labels) != len(pssm):
+            raise ValueError(f'protein {protein_id} has {len(labels)} labels but {len(pssm)} pssm rows')
+        return sequence_tensor, pssm_tensor, torch.from_numpy(labels)
+
+    #read every protein into the cache, e.g. before DataLoader worker processes are forked
+    def fill_cache(self):
+        for idx in range(len(self)):
+            self[idx]
+
+#label value used for padding, 0 is the real class 'C', so padded positions get the value CrossEntropyLoss ignores by default
+LABEL_PAD = -100
+
+#number of input channels of the model, the acid index and the 20 pssm values
+input_channels = len(acid_seq) + 1
+
+#shared input builder: the collate functions write the proteins straight into the tensor the model takes, a contiguous
+#float32 (batch, 21, residues) tensor with the acid index in channel 0 and the pssm in channels 1-20, so the training and
+#prediction loops pass it to the model as it is. this is the only place the narrow residue and pssm types are widened.
+#write_input puts one protein into row of x from position start and returns the position after it
+def write_input(x, row, start, sequence, pssm):
+    end = start + len(sequence)
+    x[row, 0, start:end] = sequence
+    x[row, 1:, start:end] = pssm.T
+    return end
+
+#the labels of the batch, one protein per row padded with LABEL_PAD, widened from uint8 to the long type
+#CrossEntropyLoss needs only here
+def build_labels(labels):
+    padded = torch.full((len(labels), max(len(label) for label in labels)), LABEL_PAD, dtype=torch.long)
+    for row, label in enumerate(labels):
+        padded[row, :len(label)] = label
+    return padded
+
+#one protein per row, zero padded to the longest protein
+def build_inputs(sequences, pssms):
+    x = torch.zeros(len(sequences), input_channels, max(len(sequence) for sequence in sequences))
+    for row, (sequence, pssm) in enumerate(zip(sequences, pssms)):
+        write_input(x, row, 0, sequence, pssm)
+    return x
+
+#used to pad train dataset, since proteins have different number of residues. returns the model input and the labels
+def collate_fn(batch):
+    sequences, pssms, labels = zip(*batch)
+    return build_inputs(sequences, pssms), build_labels(labels)
+#used to pad test dataset because it does not contain label tensor, the model input is returned in a tuple like the
+#batches of the other collate functions
+def collate_fn2(batch):
+    sequences, pssms= zip(*batch)
+    return (build_inputs(sequences, pssms),)
+
+#used in packed mode instead of padding: the proteins of a batch are joined into one long sequence (batch size 1) with
+#gap zero positions between them. returns the model input, the labels (LABEL_PAD in the gaps, only for the train
+#dataset), a mask that is True on real residues and the number of residues of every protein
+def collate_packed(batch, gap):
+    has_labels = len(batch[0]) == 3
+    lengths = torch.tensor([len(item[0]) for item in batch])
+    total_length = int(lengths.sum()) + gap * (len(batch) - 1)
+    x = torch.zeros(1, input_channels, total_length)
+    labels = torch.full((1, total_length), LABEL_PAD, dtype=torch.long)
+    mask = torch.zeros(1, total_length, dtype=torch.bool)
+    start = 0
+    for item in batch:
+        end = write_input(x, 0, start, item[0], item[1])
+        mask[0, start:end] = True
+        if has_labels:
+            labels[0, start:end] = item[2]
+        start = end + gap
+    if has_labels:
+        return x, labels, mask, lengths
+    return x, mask, lengths
+
+#collate function for a model, padded or packed with the gap the model needs
+def collate_for(model, packed, has_labels=True):
+    if packed:
+        return partial(collate_packed, gap=model.pack_gap)
+    return collate_fn if has_labels else collate_fn2
+
+#split the predictions of a packed batch back into one array per protein
+def unpack_predictions(predicted, mask, lengths):
+    return [pred.cpu().numpy() for pred in predicted[mask].split(lengths.tolist())]
+
+#get the number of residues of every protein in a dataset (or a Subset made by random_split)
+def protein_lengths(dataset):
+    if isinstance(dataset, Subset):
+        return protein_lengths(dataset.dataset)[np.asarray(dataset.indices)]
+    #with a store the lengths come straight from the offsets
+    if getattr(dataset, 'store_path', None) is not None:
+        return np.diff(dataset.offsets)
+    #without a store every protein has to be read once
+    return np.array([len(dataset[i][0]) for i in range(len(dataset))])
+
+#the ids of the proteins of a dataset (or a Subset made by random_split, or a ConcatDataset of them) in dataset order
+def dataset_protein_ids(dataset):
+    if isinstance(dataset, Subset):
+        ids = dataset_protein_ids(dataset.dataset)
+        return [ids[i] for i in dataset.indices]
+    if isinstance(dataset, ConcatDataset):
+        return [protein_id for part in dataset.datasets for protein_id in dataset_protein_ids(part)]
+    return list(dataset.protein_ids)
+
+#batch sampler that groups proteins of similar length and fills each batch up to max_residues, counted with padding
+#(longest protein in the batch * number of proteins), so the convolutions spend little time on padding.
+#every epoch the proteins are shuffled, sorted by length inside pools of bucket_size proteins (the whole dataset by default)
+#and cut into batches, then the order of the batches is shuffled
+class LengthBucketSampler(Sampler):
+    def __init__(self, lengths, max_residues, bucket_size=None, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.max_residues = max_residues
+        self.bucket_size = bucket_size or len(self.lengths)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self.make_batches(self.epoch)
+
+    def make_batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            pool = order[start:start + self.bucket_size]
+            #stable sort, so proteins of the same length stay in shuffled order
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batch, longest = [], 0
+            for idx in pool:
+                #start a new batch when adding this protein would go over the residue budget
+                if batch and max(longest, self.lengths[idx]) * (len(batch) + 1) > self.max_residues:
+                    batches.append(batch)
+                    batch, longest = [], 0
+                batch.append(int(idx))
+                longest = max(longest, self.lengths[idx])
+            if batch:
+                batches.append(batch)
+        #shuffle between buckets
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        self.batches = self.make_batches(self.epoch)
+        self.epoch += 1
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+#share of the positions in padded batches that are padding, for a list of batches of dataset indices
+def padding_ratio(batches, lengths):
+    lengths = np.asarray(lengths)
+    real_residues = 0
+    padded_residues = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real_residues += batch_lengths.sum()
+        padded_residues += batch_lengths.max() * len(batch)
+    return 1 - real_residues / padded_residues
+
+#keyword arguments for DataLoader: number of worker processes, keeping the workers alive between epochs, batches loaded
+#ahead by each worker and pinned memory. the worker-only options are left out when loading in the main process
+def loader_options(num_workers=0, persistent_workers=False, prefetch_factor=2, pin_memory=False):
+    options = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        options.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    return options
+
+#iterate a DataLoader (or any iterable of batches) in a background thread that keeps up to depth collated batches ready
+#in a bounded queue, so loading and building the input of the next batches overlaps the model's work on this one without
+#starting worker processes. stats() gives the numbers of the latest pass: batches, stall_s (time spent waiting for an
+#empty queue) and mean_depth (batches ready when one was taken, depth means loading keeps up)
+class BatchPrefetcher:
+    def __init__(self, loader, depth=2):
+        self.loader = loader
+        self.depth = depth
+        self.batches = 0
+        self.stall = 0.0
+        self.depth_sum = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    #put an item in the queue unless the consumer has quit (stop is set), returns whether it was put
+    @staticmethod
+    def offer(ready, stop, item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    #runs in the thread, the end of the loader is (None, None) and an exception is handed over to be raised in the consumer
+    def produce(self, ready, stop):
+        try:
+            for batch in self.loader:
+                if not self.offer(ready, stop, (batch, None)):
+                    return
+            self.offer(ready, stop, (None, None))
+        except Exception as error:
+            self.offer(ready, stop, (None, error))
+
+    def __iter__(self):
+        self.batches, self.stall, self.depth_sum = 0, 0.0, 0
+        ready = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(ready, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.depth_sum += ready.qsize()
+                start = time.perf_counter()
+                batch, error = ready.get()
+                self.stall += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                self.batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    #hits, misses and evictions, since an earlier counts() if since is given
+    def counts(self, since=None):
+        since = since or {}
+        return {name: getattr(self, name) - since.get(name, 0) for name in ('hits', 'misses', 'evictions')}
+
+    def add_counts(self, counts):
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def stats(self):
+        return {'batches': self.batches, 'stall_s': round(self.stall, 6),
+                'mean_depth': self.depth_sum / max(1, self.batches + 1)}
@@ -0,0 +1,140 @@
+#data-parallel training of one model in several local processes with torch.distributed (gloo backend, cpu).
+#every process trains on its own share of each batch and the gradients are averaged after every backward pass, process 0
+#validates, logs and saves the checkpoints and tells the others when to stop
+
+import os
+import socket
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+
+from protein_data import LABEL_PAD, collate_for, loader_options
+from protein_metrics import MetricsLog
+from protein_train import (TrainingProgress, build_model, checkpoint_path, load_model_checkpoint, make_validation_loader,
+                          resume_last_checkpoint, run_settings, save_best_checkpoint, save_last_checkpoint, val_pred)
+
+#a free local port for the processes to meet on
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+#one process of train_distributed. each process gets batch_size / world_size proteins of every batch from a
+#DistributedSampler, which shuffles the same way in every process. the loss of a process is summed over its residues
+#and divided by the residues of the whole batch (times world_size, since DistributedDataParallel averages the
+#gradients), so the gradient is the one of the whole batch in a single process.
+#the progress and checkpoints are kept with the helpers of train_loop (TrainingProgress, save_best_checkpoint,
+#save_last_checkpoint), so the checkpoints have its format: process 0 saves the training state after every epoch to the
+#last checkpoint with the random state of every process, and every process resumes from it with resume_last_checkpoint
+def distributed_worker(rank, world_size, port, parameters, train_dataset, validation_dataset, num_ep, patience,
+                       trial_index, packed, loader_kwargs, seed, checkpoint_dir, initial_state, results, settings, resume):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        #the same initial weights in every process, dropout differs between them
+        torch.manual_seed(seed)
+        model = build_model(parameters)
+        optimizer = torch.optim.Adam(model.parameters(), parameters['lr'])
+        if initial_state is not None:
+            model.load_state_dict(initial_state['model'])
+            optimizer.load_state_dict(initial_state['optimizer'])
+        torch.manual_seed(seed + rank)
+        progress = TrainingProgress(patience)
+
+        sampler = DistributedSampler(train_dataset, world_size, rank, shuffle=True, seed=seed)
+        train_loader = DataLoader(train_dataset, max(1, parameters['batch_size'] // world_size), sampler=sampler,
+                                  collate_fn=collate_for(model, packed), generator=torch.Generator().manual_seed(seed), **loader_kwargs)
+        if resume:
+            resume_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, train_loader, rank)
+        ddp_model = DistributedDataParallel(model)
+        loss_sum = torch.nn.CrossEntropyLoss(reduction='sum')
+        if rank == 0:
+            loss_fn = torch.nn.CrossEntropyLoss()
+            validation_loader = make_validation_loader(validation_dataset, parameters['batch_size'], None,
+                                                       collate_for(model, packed), loader_kwargs)
+            metrics_log = MetricsLog()
+
+        for epoch in range(progress.next_epoch, num_ep):
+            if progress.finished:
+                break
+            sampler.set_epoch(epoch)
+            ddp_model.train()
+            running_loss = torch.zeros(1)
+            steps = 0
+            epoch_start = time.perf_counter()
+            for batch in train_loader:
+                x, labels = batch[:2]
+                mask = batch[2] if packed else None
+                residues = (labels != LABEL_PAD).sum().float().reshape(1)
+                dist.all_reduce(residues)
+                optimizer.zero_grad()
+                loss = loss_sum(ddp_model(x, mask), labels) / residues * world_size
+                loss.backward()
+                optimizer.step()
+                running_loss += loss.detach() / world_size
+                steps += 1
+            #the loss of every step over the whole batch, averaged over the epoch like train_loop does
+            dist.all_reduce(running_loss)
+            avg_train_loss = running_loss.item() / steps
+            train_time = time.perf_counter() - epoch_start
+
+            #process 0 validates and keeps the progress, the others only follow when it finishes
+            if rank == 0:
+                metrics, avg_test_loss = val_pred(model, validation_loader, loss_fn, packed)
+                accuracy = metrics['accuracy']
+                print(f'Epoch {epoch+1}/{num_ep}, Training Loss: {avg_train_loss:.4f}, Test Loss: {avg_test_loss:.4f},Accuracy : {accuracy:.4f}%')
+                metrics_log.log({'trial': trial_index, 'epoch': epoch, 'train_loss': avg_train_loss, 'val_loss': avg_test_loss,
+                                 'val_accuracy': accuracy, 'train_s': train_time, 'processes': world_size})
+                if progress.add_epoch(epoch, avg_train_loss, avg_test_loss, accuracy):
+                    save_best_checkpoint(checkpoint_dir, trial_index, model, optimizer, epoch, accuracy, parameters)
+            stop = torch.tensor([float(progress.finished)])
+            dist.broadcast(stop, 0)
+            progress.finished = bool(stop.item())
+
+            #the main process loads the model from the last checkpoint
+            rng_states = [None] * world_size
+            dist.all_gather_object(rng_states, torch.get_rng_state())
+            if rank == 0:
+                save_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, num_ep,
+                                     rng_states, train_loader)
+
+        #a resumed run that had finished returns the results of its last epoch
+        if rank == 0:
+            results.put((metrics_log.records, progress.test_losses[-1], progress.accuracies[-1]))
+    finally:
+        dist.destroy_process_group()
+
+#train a model with the hyperparameters in parameters for up to num_ep epochs in world_size processes, starting from
+#initial_state (a checkpoint with 'model' and 'optimizer', e.g. the best trial's) if given. the batches have
+#parameters['batch_size'] proteins in total, split between the processes; in packed mode the loss curve is the one
+#single-process training with the same shuffling gives. returns the last validation loss and accuracy and the trained
+#model like train_loop, the best and last checkpoints are saved in checkpoint_dir (a temporary folder if not given)
+#and every epoch is added to metrics_log. with resume=True an interrupted run with the same parameters and settings
+#(see run_settings, the number of processes always counts) continues from its last checkpoint. processes are forked where possible and spawned on Windows, where they import
+#the modules again (the script that calls this has to keep its work under if __name__ == '__main__')
+def train_distributed(parameters, train_dataset, validation_dataset, world_size, num_ep, patience, trial_index='final',
+                      packed=False, loader_kwargs=None, seed=0, checkpoint_dir=None, initial_state=None, metrics_log=None,
+                      settings=None, resume=True):
+    settings = run_settings(train_dataset, validation_dataset, packed, False, {'processes': world_size, **(settings or {})})
+    with tempfile.TemporaryDirectory() as temporary:
+        checkpoint_dir = checkpoint_dir or temporary
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+        results = mp.get_context(start_method).SimpleQueue()
+        context = mp.start_processes(distributed_worker, nprocs=world_size, join=False, start_method=start_method,
+                                     args=(world_size, free_port(), parameters, train_dataset, validation_dataset, num_ep,
+                                           patience, trial_index, packed, loader_kwargs or loader_options(), seed,
+                                           checkpoint_dir, initial_state, results, settings, resume))
+        #raises if a process failed, the results are small enough to wait in the queue until all processes are done
+        while not context.join():
+            pass
+        records, avg_test_loss, accuracy = results.get()
+        model, _ = load_model_checkpoint(checkpoint_path(checkpoint_dir, trial_index, 'last'))
+    if metrics_log is not None:
+        metrics_log.extend(records)
+    return avg_test_loss, accuracy, model
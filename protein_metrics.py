@@ -0,0 +1,93 @@
+#per-epoch metrics of the trials and timing of the training loop. every epoch of every trial is one record in a
+#MetricsLog, written as a json line so the logs of different runs can be compared, e.g. with pandas.read_json(path, lines=True)
+
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+#records of the trained epochs. with a path, every record is appended to that jsonl file as it is logged, and the records
+#already in the file are read first, so a restarted run continues its log. a trial that trains an epoch again replaces
+#the earlier record of that epoch in the curves
+class MetricsLog:
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                self.records = [json.loads(line) for line in file if line.strip()]
+
+    def log(self, record):
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+    def extend(self, records):
+        for record in records:
+            self.log(record)
+
+    #values of one key for every epoch of a trial, in epoch order. the records of a cross-validated trial have a 'fold'
+    #key, its curve is the mean over the folds that trained the epoch
+    def curve(self, trial_index, key):
+        epochs = {}
+        for record in self.records:
+            if record['trial'] == trial_index:
+                epochs.setdefault(record['epoch'], {})[record.get('fold')] = record[key]
+        return [sum(epochs[epoch].values()) / len(epochs[epoch]) for epoch in sorted(epochs)]
+
+    #{trial index: curve} for every trial, the layout plot_metrics takes
+    def curves(self, key):
+        trials = dict.fromkeys(record['trial'] for record in self.records)
+        return {trial_index: self.curve(trial_index, key) for trial_index in trials}
+
+    #write the records as a csv table, the stage timings become time_<stage> columns
+    def to_csv(self, path):
+        import pandas as pd
+        pd.json_normalize(self.records, sep='_').to_csv(path, index=False)
+
+#wall time of the stages of the training loop. with enabled=False every stage is a no-op context
+class StageTimer:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.totals = {}
+
+    def stage(self, name):
+        return self.timed(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    #wrap a collate function so its time is counted too, only possible when batches are loaded in this process
+    def wrap(self, name, fn):
+        def timed_fn(*args, **kwargs):
+            with self.timed(name):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    #the totals since the last reset, rounded for the log
+    def reset(self):
+        totals = {name: round(seconds, 6) for name, seconds in self.totals.items()}
+        self.totals = {}
+        return totals
+
+#torch.profiler over the training steps first_step to first_step + n_steps - 1 of an epoch, the trace is written to
+#trace_path in chrome trace format (chrome://tracing or perfetto). the profiler has to be stepped after every batch
+def step_profiler(first_step, n_steps, trace_path):
+    warmup = 1 if first_step > 0 else 0
+    return torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU],
+        schedule=torch.profiler.schedule(wait=first_step - warmup, warmup=warmup, active=n_steps, repeat=1),
+        on_trace_ready=lambda profiler: profiler.export_chrome_trace(trace_path),
+        record_shapes=True,
+    )
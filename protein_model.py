@@ -0,0 +1,110 @@
+#the convolutional network that predicts a secondary structure for every residue
+
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+#depthwise separable convolution: every channel is convolved on its own, then a 1x1 convolution mixes the channels,
+#about kernel_size times fewer multiplications than a full convolution
+class SeparableConv1d(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size, padding, dilation=1):
+        super(SeparableConv1d, self).__init__()
+        self.depthwise = nn.Conv1d(in_channels, in_channels, kernel_size, padding=padding, dilation=dilation, groups=in_channels)
+        self.pointwise = nn.Conv1d(in_channels, out_channels, kernel_size=1)
+
+    def forward(self, x):
+        return self.pointwise(self.depthwise(x))
+
+#this is the net: depth convolutions with output_channels, 2 * output_channels, 4 * output_channels, ... channels, each
+#followed by relu and dropout, then a 1x1 convolution to the classes. the defaults are the original network
+#(21 -> 64 -> 128 -> 256, kernel 5). cheaper variants: separable=True makes every convolution after the first
+#depthwise separable (the first one only sees the 21 input channels), dilation > 1 spaces the kernel of layer i by
+#dilation ** i, which widens the receptive field without more weights
+class ProteinCNN(nn.Module):
+    def __init__(self, input_channels,output_channels, num_classes,dropout_rate, depth=3, kernel_size=5, separable=False, dilation=1):
+        super(ProteinCNN, self).__init__()
+        self.input_channels = input_channels
+        self.convs = nn.ModuleList()
+        channels = input_channels
+        for i in range(depth):
+            layer_dilation = dilation ** i
+            padding = layer_dilation * (kernel_size - 1) // 2
+            if separable and i > 0:
+                self.convs.append(SeparableConv1d(channels, output_channels * 2 ** i, kernel_size, padding, layer_dilation))
+            else:
+                self.convs.append(nn.Conv1d(channels, output_channels * 2 ** i, kernel_size, padding=padding, dilation=layer_dilation))
+            channels = output_channels * 2 ** i
+
+        self.final_conv = nn.Conv1d(channels, num_classes, kernel_size=1)
+        self.relu = nn.ReLU()
+        #add dropout to prevent overfitting
+        self.dropout = nn.Dropout(dropout_rate)
+        #widest padding of the convolutions, the number of zero positions needed between proteins in packed mode
+        self.pack_gap = max(conv.padding[0] for conv in self.modules() if isinstance(conv, nn.Conv1d))
+        self._register_load_state_dict_pre_hook(rename_legacy_convs)
+
+    #mask (batch, residues) is True on real residues, zeroing the other positions after every layer keeps the gaps and
+    #padding at zero, so a convolution sees them the same way as its own zero padding and nothing leaks between proteins.
+    #masked_fill keeps the dtype of the activations (bfloat16 in fast mode), the annotation is needed by TorchScript
+    def forward(self, x, mask: Optional[torch.Tensor] = None):
+        if mask is not None:
+            mask = ~mask.unsqueeze(1)
+
+        for conv in self.convs:
+            x = self.relu(conv(x))
+            x = self.dropout(x)
+            if mask is not None:
+                x = x.masked_fill(mask, 0)
+        x = self.final_conv(x)
+
+        return x
+
+#checkpoints saved before the layers were configurable name them conv1, conv2 and conv3
+def rename_legacy_convs(state_dict, prefix, *args):
+    for key in [key for key in state_dict if key.startswith(prefix + 'conv') and not key.startswith(prefix + 'convs.')]:
+        layer, rest = key[len(prefix) + 4:].split('.', 1)
+        state_dict[f'{prefix}convs.{int(layer) - 1}.{rest}'] = state_dict.pop(key)
+
+#number of weights of a model
+def count_parameters(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+#multiply-adds of the convolutions for every residue of a protein, times 2 to count them as floating point operations
+def flops_per_residue(model):
+    return sum(2 * conv.weight.numel() for conv in model.modules() if isinstance(conv, nn.Conv1d))
+
+#number of residues on each side of a residue that its prediction depends on, the reach of all the convolutions added up.
+#a quantized model has no nn.Conv1d left, it keeps the radius of its float model as model.receptive_radius
+def receptive_radius(model):
+    if hasattr(model, 'receptive_radius'):
+        return model.receptive_radius
+    return sum(conv.dilation[0] * (conv.kernel_size[0] - 1) // 2 for conv in model.modules() if isinstance(conv, nn.Conv1d))
+
+#fast mode on cpu runs the model under bfloat16 autocast, with enabled=False this does nothing
+def cpu_autocast(enabled):
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+#compile the model for fast mode inference with torch.compile, with dynamic shapes since every batch has another length
+#(on cpu the training graph is compiled again for every new length, so training runs the model as it is).
+#compilation happens on the first call, so the model is tried on a small input (with and without mask) and TorchScript
+#is used instead if that fails, e.g. without a C++ compiler (TorchScript runs in float32, it does not follow autocast).
+#a model that is still being trained (training=True) shares its parameters with the compiled one, otherwise the
+#TorchScript model is frozen and optimized for oneDNN
+def compile_model(model, training=True):
+    was_training = model.training
+    example = torch.zeros(1, model.input_channels, 16)
+    example_mask = torch.ones(1, 16, dtype=torch.bool)
+    model.eval()
+    try:
+        compiled = torch.compile(model, dynamic=True)
+        with torch.no_grad():
+            compiled(example)
+            compiled(example, example_mask)
+    except Exception as error:
+        print(f"torch.compile is not available ({type(error).__name__}), using TorchScript")
+        compiled = torch.jit.script(model)
+        if not training:
+            compiled = torch.jit.optimize_for_inference(torch.jit.freeze(compiled))
+    model.train(was_training)
+    return compiled
@@ -0,0 +1,130 @@
+#prediction of secondary structures with a trained ProteinCNN and export of the predictions
+
+import csv
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from protein_data import structure_seq, input_channels, write_input, collate_for, unpack_predictions, loader_options
+from protein_model import cpu_autocast, compile_model, receptive_radius
+
+#put test dataset into the model and yield the predictions of one protein after the other (still in numerical form),
+#one batch is kept in memory at a time. padded predictions have the length of their batch, in packed mode the loader
+#has to use collate_packed and the predictions come back already cut to each protein's length.
+#fast=True runs a compiled copy of the model under bfloat16 autocast
+def iter_predictions(model, data_loader, packed=False, fast=False):
+    if fast:
+        model = compile_model(model, training=False)
+    model.eval()  # Set the model to evaluation mode
+
+    dataset = data_loader
+    with torch.no_grad():
+        for batch in dataset:
+            #the collate function built the (batch, 21, residues) input already
+            output = batch[0]
+            mask, lengths = batch[1:] if packed else (None, None)
+
+            with cpu_autocast(fast):
+                outputs = model(output, mask)
+
+            # Convert outputs to predicted class indices
+            _, predicted = torch.max(outputs, 1)
+
+            if packed:
+                yield from unpack_predictions(predicted, mask, lengths)
+            else:
+                yield from predicted.cpu().numpy()
+
+#predict the proteins of a dataset in windows of at most window residues, so memory stays bounded however long a
+#protein is. every window gets receptive_radius residues of context on both sides, which makes the predictions of its
+#own residues exactly those of the whole protein predicted on its own (as in packed mode). batch_windows windows of any
+#proteins are predicted together, the logits are stitched back per protein and each protein is yielded as soon as all
+#its windows are done, in dataset order
+def iter_window_predictions(model, dataset, window=1024, batch_windows=16, fast=False):
+    radius = receptive_radius(model)
+    if fast:
+        model = compile_model(model, training=False)
+    model.eval()
+    items, logits, windows_left = {}, {}, {}
+    pending = []
+    next_protein = 0
+
+    #each pending window is (protein, context start, context end, start, end) in residues of its protein
+    def predict_windows():
+        width = max(context_end - context_start for _, context_start, context_end, _, _ in pending)
+        x = torch.zeros(len(pending), input_channels, width)
+        mask = torch.zeros(len(pending), width, dtype=torch.bool)
+        for row, (protein, context_start, context_end, _, _) in enumerate(pending):
+            sequence, pssm = items[protein]
+            write_input(x, row, 0, sequence[context_start:context_end], pssm[context_start:context_end])
+            mask[row, :context_end - context_start] = True
+        with torch.no_grad(), cpu_autocast(fast):
+            outputs = model(x, mask).float()
+        for row, (protein, context_start, _, start, end) in enumerate(pending):
+            logits[protein][:, start:end] = outputs[row, :, start - context_start:end - context_start]
+            windows_left[protein] -= 1
+        pending.clear()
+
+    def finished_proteins():
+        nonlocal next_protein
+        while next_protein in windows_left and windows_left[next_protein] == 0:
+            yield logits.pop(next_protein).argmax(0).numpy()
+            del items[next_protein], windows_left[next_protein]
+            next_protein += 1
+
+    for protein in range(len(dataset)):
+        sequence, pssm = dataset[protein][:2]
+        length = len(sequence)
+        items[protein] = (sequence, pssm)
+        logits[protein] = torch.empty(len(structure_seq), length)
+        windows_left[protein] = -(-length // window)
+        for start in range(0, length, window):
+            end = min(start + window, length)
+            pending.append((protein, max(0, start - radius), min(length, end + radius), start, end))
+            if len(pending) == batch_windows:
+                predict_windows()
+                yield from finished_proteins()
+    if pending:
+        predict_windows()
+    yield from finished_proteins()
+
+#get the predictions of iter_predictions as a list. with a window the proteins of the loader's dataset are predicted
+#in windows instead (see iter_window_predictions), in dataset order, so the loader must not shuffle
+def evaluation(model, data_loader, packed=False, fast=False, window=None, batch_windows=16):
+    if window is not None:
+        return list(iter_window_predictions(model, data_loader.dataset, window, batch_windows, fast))
+    return list(iter_predictions(model, data_loader, packed, fast))
+
+#predict the test dataset and stream the predictions into a csv file with one row (ID, Structure) per residue, ID being
+#<protein id>_<residue number>. proteins are predicted and written in the order of seqs_csv_path, each batch is written
+#as soon as it is predicted and trimmed to the length of the sequence in seqs_csv_path, so memory does not grow with
+#the size of the test set and every input file is read once. with a window, proteins are predicted in windows of that
+#many residues (see iter_window_predictions), batch_size windows at a time
+def write_predictions(model, dataset, seqs_csv_path, out_path, batch_size, packed=False, fast=False, loader_kwargs=None, window=None):
+    #protein ids and sequence lengths in the required order
+    with open(seqs_csv_path, mode='r') as seq_file:
+        seq_reader = csv.reader(seq_file)
+        next(seq_reader, None)
+        proteins = [(row[0], len(row[1])) for row in seq_reader]
+
+    index = {protein_id: i for i, protein_id in enumerate(dataset.protein_ids)}
+    missing = [protein_id for protein_id, _ in proteins if protein_id not in index]
+    if missing:
+        raise ValueError(f'{len(missing)} proteins of {seqs_csv_path} are not in the dataset, e.g. {missing[0]}')
+    ordered = Subset(dataset, [index[protein_id] for protein_id, _ in proteins])
+    if window is not None:
+        predictions = iter_window_predictions(model, ordered, window, batch_size, fast)
+    else:
+        loader = DataLoader(ordered, batch_size, shuffle=False, collate_fn=collate_for(model, packed, has_labels=False),
+                            **(loader_kwargs or loader_options()))
+        predictions = iter_predictions(model, loader, packed, fast)
+
+    structures = np.array(list(structure_seq))
+    with open(out_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['ID', 'Structure'])
+        for (protein_id, length), pred in zip(proteins, predictions):
+            if len(pred) < length:
+                raise ValueError(f'protein {protein_id} has {len(pred)} residues in the dataset but {length} in {seqs_csv_path}')
+            writer.writerows(zip((f'{protein_id}_{i + 1}' for i in range(length)), structures[pred[:length]]))
@@ -0,0 +1,88 @@
+#int8 static post-training quantization of a trained ProteinCNN for inference-only use. the convolutions and their relus
+#are fused and quantized with torch.ao eager-mode quantization, the activation ranges come from a sample of the training
+#proteins. the quantized model takes the same (x, mask) input as ProteinCNN, so it can be given to evaluation,
+#write_predictions and val_pred instead of the float model (without fast mode, autocast and compile do not apply to it)
+
+import copy
+import io
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, fuse_modules, get_default_qconfig, prepare
+from torch.utils.data import DataLoader, Subset
+
+from protein_data import collate_fn
+from protein_model import receptive_radius
+from protein_train import timed_val_pred
+
+#ProteinCNN with quant/dequant stubs around the convolutions and one relu per convolution so each pair can be fused
+#(the 1x1 part of a separable convolution with its relu). dropout is left out, it does nothing in evaluation mode. masked_fill works on quantized tensors and 0 is exactly
+#representable, so the mask is applied without leaving int8
+class QuantizedProteinCNN(nn.Module):
+    def __init__(self, model):
+        super(QuantizedProteinCNN, self).__init__()
+        model = copy.deepcopy(model).cpu().eval()
+        self.quant = QuantStub()
+        self.convs = model.convs
+        self.relus = nn.ModuleList(nn.ReLU() for _ in model.convs)
+        self.final_conv = model.final_conv
+        self.dequant = DeQuantStub()
+        self.pack_gap = model.pack_gap
+        #the converted convolutions are not nn.Conv1d, so windowed prediction could not count their reach
+        self.receptive_radius = receptive_radius(model)
+
+    def forward(self, x, mask=None):
+        if mask is not None:
+            mask = ~mask.unsqueeze(1)
+        x = self.quant(x)
+        for conv, relu in zip(self.convs, self.relus):
+            x = relu(conv(x))
+            if mask is not None:
+                x = x.masked_fill(mask, 0)
+        return self.dequant(self.final_conv(x))
+
+#a loader over n_proteins random proteins of the (training) dataset for calibration
+def calibration_loader(dataset, n_proteins=256, batch_size=32, seed=0):
+    generator = np.random.default_rng(seed)
+    sample = generator.choice(len(dataset), min(n_proteins, len(dataset)), replace=False)
+    return DataLoader(Subset(dataset, sample.tolist()), batch_size, shuffle=False, collate_fn=collate_fn)
+
+#quantize a trained model, the observers see every batch of the calibration loader (padded batches with labels).
+#backend is the quantized engine, 'x86' on intel/amd cpus and 'qnnpack' on arm
+def quantize_model(model, calibration_data, backend='x86'):
+    torch.backends.quantized.engine = backend
+    quantized = QuantizedProteinCNN(model)
+    quantized.qconfig = get_default_qconfig(backend)
+    fuse_modules(quantized, [[f'convs.{i}' if isinstance(conv, nn.Conv1d) else f'convs.{i}.pointwise', f'relus.{i}']
+                             for i, conv in enumerate(quantized.convs)], inplace=True)
+    prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for x, _ in calibration_data:
+            quantized(x)
+    convert(quantized, inplace=True)
+    return quantized
+
+#size of the saved weights in bytes
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+#compare the quantized model with the float model on the validation loader: saved size, cpu time per 1000 residues
+#(the whole validation pass divided by the number of real residues) and the accuracy change in percentage points
+def quantization_report(model, quantized, data_loader, loss_fn, packed=False):
+    report = {}
+    for name, candidate in (('float', model), ('int8', quantized)):
+        metrics, _, ms = timed_val_pred(candidate, data_loader, loss_fn, packed)
+        report[name] = {
+            'size_mb': model_size(candidate) / 2 ** 20,
+            'ms_per_1k_residues': ms,
+            'accuracy': metrics['accuracy'],
+        }
+    report['accuracy_change'] = report['int8']['accuracy'] - report['float']['accuracy']
+    for name in ('float', 'int8'):
+        print(f"{name}: {report[name]['size_mb']:.2f} MB, {report[name]['ms_per_1k_residues']:.2f} ms per 1k residues, "
+              f"accuracy {report[name]['accuracy']:.4f}%")
+    print(f"int8 accuracy change {report['accuracy_change']:+.4f} points")
+    return report
@@ -0,0 +1,220 @@
+#standalone prediction service for a trained ProteinCNN. it needs torch, numpy and pandas (imported by protein_data),
+#loads a checkpoint saved by train_loop and answers POST /predict requests over local HTTP or a Unix socket. requests
+#that arrive close together are merged into micro-batches of proteins of similar length.
+#
+#    python protein_serve.py serve --checkpoint checkpoints/trial_3_best.pt --port 8000
+#    python protein_serve.py bench --port 8000 --requests 2000 --concurrency 32
+#
+#a request is {"sequence": "MKV...", "pssm": [[20 values] for every residue]}, the answer {"structure": "CCHH..."}
+
+import argparse
+import http.client
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from protein_data import acid_seq, structure_seq, encode_residues, build_inputs, LengthBucketSampler
+from protein_model import cpu_autocast, compile_model
+from protein_train import load_model_checkpoint
+
+#collects the submitted proteins in a background thread. after the first protein of a micro-batch arrives, more are
+#taken until max_wait_ms have passed or max_residues residues are waiting. the proteins are then sorted into padded
+#batches of similar length with at most max_residues padded residues each, and the mask keeps padding from changing
+#the predictions
+class MicroBatcher:
+    def __init__(self, model, max_residues=16000, max_wait_ms=10, fast=False):
+        self.model = compile_model(model, training=False) if fast else model
+        self.model.eval()
+        self.max_residues = max_residues
+        self.max_wait = max_wait_ms / 1000
+        self.fast = fast
+        self.requests = queue.Queue()
+        self.batches_run = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #queue one protein, the future gets the predicted structure string
+    def submit(self, sequence, pssm):
+        future = Future()
+        self.requests.put((sequence, pssm, future))
+        return future
+
+    def run(self):
+        while True:
+            pending = [self.requests.get()]
+            waiting_residues = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while waiting_residues < self.max_residues:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                waiting_residues += len(pending[-1][0])
+            lengths = [len(sequence) for sequence, _, _ in pending]
+            for batch in LengthBucketSampler(lengths, self.max_residues, shuffle=False).batches:
+                self.predict([pending[i] for i in batch])
+
+    def predict(self, batch):
+        try:
+            sequences, pssms, futures = zip(*batch)
+            lengths = torch.tensor([len(sequence) for sequence in sequences])
+            mask = torch.arange(int(lengths.max()))[None, :] < lengths[:, None]
+            x = build_inputs(sequences, pssms)
+            with torch.no_grad(), cpu_autocast(self.fast):
+                predicted = self.model(x, mask).argmax(1).numpy()
+            self.batches_run += 1
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+            return
+        structures = np.array(list(structure_seq))
+        for future, pred, length in zip(futures, predicted, lengths.tolist()):
+            future.set_result(''.join(structures[pred[:length]]))
+
+#turn the json body of a request into the sequence and pssm tensors, ValueError for malformed input
+def parse_protein(body):
+    request = json.loads(body)
+    sequence = request['sequence']
+    pssm = np.asarray(request['pssm'], dtype=np.float32)
+    if len(sequence) == 0 or pssm.shape != (len(sequence), len(acid_seq)):
+        raise ValueError(f'pssm must have one row of {len(acid_seq)} values for each of the {len(sequence)} residues')
+    return torch.from_numpy(encode_residues(list(sequence), 'in request')), torch.from_numpy(pssm)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, {'status': 'ok', 'batches': self.batcher.batches_run})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            sequence, pssm = parse_protein(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except (ValueError, KeyError, TypeError) as error:
+            return self.reply(400, {'error': str(error)})
+        try:
+            structure = self.batcher.submit(sequence, pssm).result()
+        except Exception as error:
+            return self.reply(500, {'error': str(error)})
+        self.reply(200, {'structure': structure})
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    #keep the console quiet, Unix socket clients have no address to log anyway
+    def log_message(self, format, *args):
+        pass
+
+#a longer listen backlog than the default 5, so a burst of clients connecting at once is not reset
+class PredictionServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+#serve predictions of the checkpoint on host:port, or on a Unix socket if unix_path is given
+def serve(checkpoint, host='127.0.0.1', port=8000, unix_path=None, max_residues=16000, max_wait_ms=10, fast=False):
+    model, _ = load_model_checkpoint(checkpoint)
+    PredictionHandler.batcher = MicroBatcher(model, max_residues, max_wait_ms, fast)
+    if unix_path is not None:
+        server = ThreadingUnixHTTPServer(unix_path, PredictionHandler)
+        print(f"Serving {checkpoint} on unix:{unix_path}")
+    else:
+        server = PredictionServer((host, port), PredictionHandler)
+        print(f"Serving {checkpoint} on http://{host}:{port}")
+    server.serve_forever()
+
+#http.client connection over a Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_path):
+        super().__init__('localhost')
+        self.unix_path = unix_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+#local load generator: concurrency clients send n_requests random proteins with lengths between min_length and
+#max_length, each client over its own keep-alive connection. returns p50/p99 latency in ms and the throughput
+def load_test(host='127.0.0.1', port=8000, unix_path=None, n_requests=1000, concurrency=16, min_length=50, max_length=500, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_length, max_length + 1, n_requests)
+    bodies = [json.dumps({'sequence': ''.join(rng.choice(list(acid_seq), length)),
+                          'pssm': rng.normal(size=(length, len(acid_seq))).round(3).tolist()}).encode()
+              for length in lengths]
+
+    def client(worker):
+        connection = UnixHTTPConnection(unix_path) if unix_path is not None else http.client.HTTPConnection(host, port)
+        latencies = []
+        for body in bodies[worker::concurrency]:
+            start = time.perf_counter()
+            connection.request('POST', '/predict', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f'request failed with status {response.status}')
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = np.concatenate([np.asarray(result) for result in pool.map(client, range(concurrency))])
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'requests_per_s': n_requests / elapsed,
+        'residues_per_s': float(lengths.sum()) / elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='ProteinCNN prediction service')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'bench'):
+        command = commands.add_parser(name)
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8000)
+        command.add_argument('--unix', dest='unix_path', help='serve on / connect to this Unix socket instead')
+    serve_parser = commands.choices['serve']
+    serve_parser.add_argument('--checkpoint', required=True, help='checkpoint file saved by train_loop')
+    serve_parser.add_argument('--max-residues', type=int, default=16000, help='padded residues per micro-batch')
+    serve_parser.add_argument('--max-wait-ms', type=float, default=10, help='how long a request waits for others')
+    serve_parser.add_argument('--fast', action='store_true', help='compiled model under bfloat16 autocast')
+    bench_parser = commands.choices['bench']
+    bench_parser.add_argument('--requests', type=int, default=1000)
+    bench_parser.add_argument('--concurrency', type=int, default=16)
+    bench_parser.add_argument('--min-length', type=int, default=50)
+    bench_parser.add_argument('--max-length', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.checkpoint, args.host, args.port, args.unix_path, args.max_residues, args.max_wait_ms, args.fast)
+    else:
+        print(json.dumps(load_test(args.host, args.port, args.unix_path, args.requests, args.concurrency,
+                                   args.min_length, args.max_length), indent=2))
+
+if __name__ == '__main__':
+    main()
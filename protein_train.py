@@ -0,0 +1,567 @@
+#training and validation of ProteinCNN, and the runner that trains Ax trials in parallel worker processes
+
+import multiprocessing
+import os
+import hashlib
+import random
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torch.utils.data import ConcatDataset, DataLoader, RandomSampler, Subset
+
+from protein_data import LABEL_PAD, structure_seq, input_channels, collate_for, protein_lengths, LengthBucketSampler, padding_ratio, loader_options, BatchPrefetcher, dataset_protein_ids
+from protein_model import ProteinCNN, cpu_autocast, compile_model, count_parameters, flops_per_residue, receptive_radius
+from protein_metrics import MetricsLog, StageTimer, step_profiler
+
+#run the model on the validation set and get the test loss and the metrics of confusion_metrics. the predictions are compared
+#with the labels while the batches are processed, by adding up a confusion matrix (rows are true, columns predicted structures)
+#with tensor ops, positions with LABEL_PAD (padding, gaps in packed mode) are left out.
+#fast runs the forward pass under bfloat16 autocast (the caller passes the compiled model).
+#with prefetch set, that many batches are loaded ahead in a background thread by a BatchPrefetcher
+def val_pred(model,data_loader,loss_fn,packed=False,fast=False,prefetch=None):
+    model.eval()  # Set the model to evaluation mode
+    num_classes = len(structure_seq)
+    confusion = None
+    total_loss = 0.0
+    dataset = BatchPrefetcher(data_loader, prefetch) if prefetch else data_loader
+    with torch.no_grad():
+
+        for batch in dataset:
+            #the collate function built the (batch, 21, residues) input already
+            output, labels = batch[:2]
+            mask = batch[2] if packed else None
+
+            with cpu_autocast(fast):
+                outputs = model(output, mask)
+                loss = loss_fn(outputs, labels)
+            total_loss += loss.item()
+            # Convert outputs to predicted class indices
+            _, predicted = torch.max(outputs, 1)
+
+            #count every (true, predicted) pair of the real residues
+            real = labels != LABEL_PAD
+            pairs = labels[real] * num_classes + predicted[real]
+            counts = torch.bincount(pairs, minlength=num_classes * num_classes).view(num_classes, num_classes)
+            confusion = counts if confusion is None else confusion + counts
+        #calculate loss
+        average_test_loss = total_loss / len(data_loader)
+        print('loss' + ':' + str(average_test_loss))
+    #return the metrics and average test loss
+    return confusion_metrics(confusion), average_test_loss
+
+#val_pred that also measures the wall time per 1000 real residues, returns the metrics, the loss and the time in ms
+def timed_val_pred(model, data_loader, loss_fn, packed=False):
+    start = time.perf_counter()
+    metrics, average_test_loss = val_pred(model, data_loader, loss_fn, packed)
+    elapsed = time.perf_counter() - start
+    return metrics, average_test_loss, elapsed * 1000 / (int(np.sum(metrics['confusion'])) / 1000)
+
+#get the metrics from a confusion matrix: accuracy in percent (which is Q3, the share of residues with the right one of
+#the 3 structures), and precision and recall in percent for each structure
+def confusion_metrics(confusion):
+    confusion = confusion.double()
+    correct = confusion.diagonal()
+    accuracy = correct.sum() / confusion.sum().clamp(min=1) * 100
+    precision = correct / confusion.sum(dim=0).clamp(min=1) * 100
+    recall = correct / confusion.sum(dim=1).clamp(min=1) * 100
+    return {
+        'accuracy': accuracy.item(),
+        'q3': accuracy.item(),
+        'precision': dict(zip(structure_seq, precision.tolist())),
+        'recall': dict(zip(structure_seq, recall.tolist())),
+        'confusion': confusion.long().tolist(),
+    }
+
+#median stopping rule for the search. from warmup_epochs on, a trial is stopped when its best validation accuracy so far
+#is below the median of the best accuracies the finished trials had reached by the same epoch. it needs at least
+#min_trials finished trials to compare with. run_trials_parallel adds every finished trial, a running trial compares
+#with the trials that had finished when it was started
+class MedianPruner:
+    def __init__(self, warmup_epochs=3, min_trials=3):
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+        self.curves = {}
+
+    #add the per-epoch validation accuracies of a finished trial
+    def add_trial(self, trial_index, accuracies):
+        self.curves[trial_index] = list(accuracies)
+
+    #accuracies are the validation accuracies of the running trial up to and including epoch
+    def should_prune(self, epoch, accuracies):
+        if epoch + 1 < self.warmup_epochs or len(self.curves) < self.min_trials:
+            return False
+        #a finished trial that stopped before this epoch counts with the best accuracy it reached
+        reached = [max(curve[:epoch + 1]) for curve in self.curves.values() if curve]
+        return max(accuracies) < np.median(reached)
+
+#architecture hyperparameters (see ProteinCNN) and their values in the original network, which is built when a set of
+#hyperparameters does not have them
+architecture_defaults = {'width': 64, 'depth': 3, 'kernel_size': 5, 'separable': False, 'dilation': 1}
+
+#build the network for a set of hyperparameters
+def build_model(parameterization):
+    architecture = {key: parameterization.get(key, default) for key, default in architecture_defaults.items()}
+    return ProteinCNN(input_channels=input_channels, output_channels=architecture['width'], num_classes=3, dropout_rate=parameterization["dropout_rate"],
+                      depth=architecture['depth'], kernel_size=architecture['kernel_size'], separable=architecture['separable'], dilation=architecture['dilation'])
+
+#checkpoint files of a trial: 'best' holds the best epoch so far, 'last' the state after the latest epoch
+def checkpoint_path(checkpoint_dir, trial_index, kind='best'):
+    return os.path.join(checkpoint_dir, f'trial_{trial_index}_{kind}.pt')
+
+#load a checkpoint file and rebuild its model with the saved weights, returns the model and the whole checkpoint
+#(optimizer state, epoch, accuracy and the hyperparameters)
+def load_model_checkpoint(path):
+    checkpoint = torch.load(path)
+    model = build_model(checkpoint['parameters'])
+    model.load_state_dict(checkpoint['model'])
+    return model, checkpoint
+
+#load a checkpoint of a trial, see load_model_checkpoint
+def load_trial_checkpoint(checkpoint_dir, trial_index, kind='best'):
+    return load_model_checkpoint(checkpoint_path(checkpoint_dir, trial_index, kind))
+
+#a short digest of the proteins of a dataset in dataset order, so a checkpoint can tell whether it was trained on the same data
+def dataset_fingerprint(dataset):
+    return hashlib.sha1('\n'.join(dataset_protein_ids(dataset)).encode()).hexdigest()
+
+#the settings of a run that a checkpoint must share to be resumed: packing, the proteins of the training and validation
+#sets, fast mode and whatever the caller adds in settings (batching, seed, folds, processes). num_ep is left out, so a run
+#asking for more epochs continues one that trained all its epochs
+def run_settings(train_dataset, validation_dataset, packed, fast, settings=None):
+    return {'packed': packed, 'fast': fast, 'train_data': dataset_fingerprint(train_dataset),
+            'validation_data': dataset_fingerprint(validation_dataset), **(settings or {})}
+
+#the progress of a training run that its last checkpoint keeps: the losses and accuracy of every epoch, the best accuracy,
+#the epochs since it last improved and whether the run is finished (stopped early or pruned). train_loop and
+#distributed_worker both keep one, so their checkpoints are the same
+class TrainingProgress:
+    def __init__(self, patience):
+        self.patience = patience
+        self.train_losses, self.test_losses, self.accuracies = [], [], []
+        self.best_accuracy = 0
+        self.epochs_no_improve = 0
+        self.finished = False
+        self.next_epoch = 0
+
+    #add the results of an epoch, returns True if its accuracy is the best so far. after patience epochs without
+    #improvement the run is finished
+    def add_epoch(self, epoch, train_loss, test_loss, accuracy):
+        self.train_losses.append(train_loss)
+        self.test_losses.append(test_loss)
+        self.accuracies.append(accuracy)
+        self.next_epoch = epoch + 1
+        if accuracy > self.best_accuracy:
+            self.best_accuracy = accuracy
+            self.epochs_no_improve = 0
+            return True
+        self.epochs_no_improve += 1
+        if self.epochs_no_improve >= self.patience:
+            print(f"Early stopping triggered at epoch {epoch+1}")
+            self.finished = True
+        return False
+
+    def state(self):
+        return {'history': (self.train_losses, self.test_losses, self.accuracies), 'best_accuracy': self.best_accuracy,
+                'epochs_no_improve': self.epochs_no_improve, 'finished': self.finished, 'epoch': self.next_epoch - 1}
+
+    def load(self, checkpoint):
+        self.train_losses, self.test_losses, self.accuracies = checkpoint['history']
+        self.best_accuracy = checkpoint['best_accuracy']
+        self.epochs_no_improve = checkpoint['epochs_no_improve']
+        self.finished = checkpoint['finished']
+        self.next_epoch = checkpoint['epoch'] + 1
+
+#save the best epoch with the optimizer state, so the model can be used or trained further without retraining
+def save_best_checkpoint(checkpoint_dir, trial_index, model, optimizer, epoch, accuracy, parameters):
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch,
+                'accuracy': accuracy, 'parameters': parameters},
+               checkpoint_path(checkpoint_dir, trial_index, 'best'))
+
+#save the whole training state after an epoch to the last checkpoint, so an interrupted run can resume from there:
+#rng_states holds the global random state of every training process (one for train_loop), data_loader is the training
+#loader, whose shuffling generator is saved if it has one (see make_train_loader)
+def save_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, num_ep, rng_states, data_loader):
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'parameters': parameters,
+                'settings': settings, 'num_ep': num_ep, 'rng_states': rng_states, 'sampler_rng': sampler_rng(data_loader),
+                **progress.state()},
+               checkpoint_path(checkpoint_dir, trial_index, 'last'))
+
+#continue a run from the last checkpoint of its trial if it was saved with the same parameters and settings: the model,
+#optimizer and progress are loaded, the global random state of process rank and the shuffling of data_loader are
+#restored. returns True if the run was resumed. only process 0 prints
+def resume_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, data_loader, rank=0):
+    last_path = checkpoint_path(checkpoint_dir, trial_index, 'last')
+    if not os.path.exists(last_path):
+        return False
+    checkpoint = torch.load(last_path)
+    if checkpoint['parameters'] != parameters or checkpoint.get('settings') != settings:
+        if rank == 0:
+            print(f"Not resuming trial {trial_index}, its last checkpoint was saved with other parameters or settings")
+        return False
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    #single-process checkpoints saved before distributed training shared the format have one 'rng_state'
+    torch.set_rng_state(checkpoint['rng_states'][rank] if 'rng_states' in checkpoint else checkpoint['rng_state'])
+    progress.load(checkpoint)
+    if checkpoint.get('sampler_rng') is not None and getattr(data_loader.sampler, 'generator', None) is not None:
+        data_loader.sampler.generator.set_state(checkpoint['sampler_rng'])
+    #a bucket sampler continues with the shuffling of the next epoch
+    if hasattr(data_loader.batch_sampler, 'epoch'):
+        data_loader.batch_sampler.epoch = progress.next_epoch
+    if rank == 0:
+        print(f"Resuming trial {trial_index} after epoch {progress.next_epoch}")
+    return True
+
+#with a pruner, the validation accuracy of every epoch is checked by pruner.should_prune and a clearly losing trial stops early.
+#with a checkpoint_dir, the model and optimizer state of the best epoch are saved to trial_<index>_best.pt, and the whole
+#training state after every epoch to trial_<index>_last.pt. with resume=True, if trial_<index>_last.pt exists and was
+#saved with the same parameters and run settings (see run_settings), training continues after its epoch up to num_ep
+#epochs; a run that stopped early or was pruned returns at once. otherwise training starts from the beginning.
+#the global random state (dropout) and the shuffling generator of a loader made by make_train_loader are saved and
+#restored with the checkpoint, so with such a loader a resumed run trains like an uninterrupted one, whether batches are
+#loaded in this process or by worker processes. a loader shuffled from the global random state only resumes exactly in
+#this process: worker processes take their seed from it when they start.
+#fast=True trains under bfloat16 autocast and validates with a compiled copy of the model.
+#every epoch is logged to metrics_log with the losses, the accuracy and the samples and residues trained per second.
+#timing=True adds the wall time of each stage: data (waiting for the loader, which also collates and builds the input),
+#collate (only when batches are loaded in this process), forward, backward, optimizer and validation.
+#profile_steps=(first_step, n_steps) records those training steps of the first epoch run with torch.profiler and writes
+#a chrome trace to trace_path, '{trial}' in the path is replaced by the trial index.
+#prefetch=n loads the next n training and validation batches in a background thread (BatchPrefetcher) while the model
+#trains, the 'data' stage is then the time spent waiting for it. its stall time and queue depth are logged every epoch
+def train_loop(model, data_loader, test_loader, optimizer, lossfn, num_ep, patience, trial_index, packed=False, pruner=None, checkpoint_dir=None, parameters=None, fast=False,
+               metrics_log=None, timing=False, profile_steps=None, trace_path='trace_{trial}.json', prefetch=None, settings=None, resume=True):
+
+    metrics_log = metrics_log if metrics_log is not None else MetricsLog()
+    timer = StageTimer(timing)
+    num_epochs = num_ep
+    progress = TrainingProgress(patience)
+    settings = run_settings(data_loader.dataset, test_loader.dataset, packed, fast, settings)
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        if resume:
+            resume_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, data_loader)
+    #a resumed run that had finished returns the results of its last epoch
+    if progress.accuracies:
+        avg_test_loss, accuracy = progress.test_losses[-1], progress.accuracies[-1]
+    start_epoch = progress.next_epoch
+    #validation runs through the compiled model in fast mode, it shares the weights that are being trained
+    val_model = compile_model(model) if fast else model
+    collate = data_loader.collate_fn
+    if timing and data_loader.num_workers == 0 and not prefetch:
+        data_loader.collate_fn = timer.wrap('collate', collate)
+    batch_source = BatchPrefetcher(data_loader, prefetch) if prefetch else data_loader
+
+    for epoch in range(start_epoch, num_epochs):
+        if progress.finished:
+            break
+        model.train()
+        running_loss = 0.0
+        i = 0
+        accuracy = 0
+        samples = residues = 0
+        profiling = profile_steps is not None and epoch == start_epoch
+        epoch_start = time.perf_counter()
+
+        with step_profiler(*profile_steps, trace_path.format(trial=trial_index)) if profiling else nullcontext() as profiler:
+            batches = iter(batch_source)
+            while True:
+                with timer.stage('data'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                x, labels = batch[:2]
+                #in packed mode the mask keeps the proteins apart inside the joined sequence
+                mask = batch[2] if packed else None
+                optimizer.zero_grad()
+
+                with timer.stage('forward'), cpu_autocast(fast):
+                    outputs = model(x, mask)
+                    loss = lossfn(outputs, labels)
+                with timer.stage('backward'):
+                    loss.backward()
+                with timer.stage('optimizer'):
+                    optimizer.step()
+                running_loss += loss.item()
+                samples += len(batch[3]) if packed else len(labels)
+                residues += int((labels != LABEL_PAD).sum())
+                if profiling:
+                    profiler.step()
+                #report every 100 batches
+                i += 1
+                if i%100 == 0:
+                  print(f"now batch {i}")
+        train_time = time.perf_counter() - epoch_start
+        avg_train_loss = running_loss / len(data_loader)
+
+
+        #calculate the loss and accuracy on validation set
+        with timer.stage('validation'):
+            metrics, avg_test_loss = val_pred(val_model,test_loader,lossfn,packed,fast,prefetch)
+        accuracy = metrics['accuracy']
+        print(f'Epoch {epoch+1}/{num_epochs}, Training Loss: {avg_train_loss:.4f}, Test Loss: {avg_test_loss:.4f},Accuracy : {accuracy:.4f}%')
+        print('Precision: ' + ', '.join(f'{k} {v:.2f}%' for k, v in metrics['precision'].items())
+              + ' | Recall: ' + ', '.join(f'{k} {v:.2f}%' for k, v in metrics['recall'].items()))
+
+        record = {'trial': trial_index, 'epoch': epoch, 'train_loss': avg_train_loss, 'val_loss': avg_test_loss,
+                  'val_accuracy': accuracy, 'train_s': train_time, 'samples_per_s': samples / train_time,
+                  'residues_per_s': residues / train_time}
+        if timing:
+            record['time'] = timer.reset()
+        if prefetch:
+            record['prefetch'] = batch_source.stats()
+        metrics_log.log(record)
+
+        #add the losses and accuracy to the history, save the best epoch and stop after patience epochs without improvement
+        if progress.add_epoch(epoch, avg_train_loss, avg_test_loss, accuracy) and checkpoint_dir is not None:
+            save_best_checkpoint(checkpoint_dir, trial_index, model, optimizer, epoch, accuracy, parameters)
+        if not progress.finished and pruner is not None and pruner.should_prune(epoch, progress.accuracies):
+            print(f"Trial {trial_index} pruned at epoch {epoch+1}, accuracy below the median of the finished trials")
+            progress.finished = True
+
+        #save the training state after every epoch, so an interrupted run can resume from here
+        if checkpoint_dir is not None:
+            save_last_checkpoint(checkpoint_dir, trial_index, model, optimizer, progress, parameters, settings, num_epochs,
+                                 [torch.get_rng_state()], data_loader)
+
+    data_loader.collate_fn = collate
+
+    print('Finished Training')
+    # Return the best test loss, accuracy and the  model
+    return avg_test_loss, accuracy, model
+
+#the state of the generator that shuffles a loader's proteins, if it has its own (see make_train_loader)
+def sampler_rng(data_loader):
+    generator = getattr(data_loader.sampler, 'generator', None)
+    return None if generator is None else generator.get_state()
+
+#the training loader. the proteins are shuffled by a generator of their own seeded with seed (or, with max_residues,
+#bucketed by a LengthBucketSampler seeded with it), and the worker processes get their seeds from another generator,
+#so loading never draws from the global random state that drives dropout
+def make_train_loader(train_dataset, batch_size, max_residues, collate, loader_kwargs, seed=0):
+    worker_seeds = torch.Generator().manual_seed(seed)
+    if max_residues is not None:
+        return DataLoader(train_dataset, batch_sampler=make_bucket_sampler(train_dataset, max_residues, batch_size, seed), collate_fn=collate,
+                          generator=worker_seeds, **loader_kwargs)
+    sampler = RandomSampler(train_dataset, generator=torch.Generator().manual_seed(seed))
+    return DataLoader(train_dataset, batch_size, sampler=sampler, collate_fn=collate, generator=worker_seeds, **loader_kwargs)
+
+#validation batches can be bucketed by length as well, since the metrics do not depend on the order of the proteins.
+#the seeds of worker processes come from a generator of the loader, not from the global random state
+def make_validation_loader(validation_dataset, batch_size, max_residues, collate, loader_kwargs):
+    if max_residues is not None:
+        sampler = LengthBucketSampler(protein_lengths(validation_dataset), max_residues, shuffle=False)
+        return DataLoader(validation_dataset, batch_sampler=sampler, collate_fn=collate, generator=torch.Generator(), **loader_kwargs)
+    return DataLoader(validation_dataset, batch_size, shuffle=False, collate_fn=collate, generator=torch.Generator(), **loader_kwargs)
+
+#make a LengthBucketSampler for a dataset and report how much padding it saves compared to shuffled batches of batch_size
+def make_bucket_sampler(dataset, max_residues, batch_size, seed=0):
+    lengths = protein_lengths(dataset)
+    sampler = LengthBucketSampler(lengths, max_residues, seed=seed)
+    order = np.random.permutation(len(lengths))
+    fixed_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    print(f"Padding ratio with residue budget {max_residues}: {padding_ratio(sampler.batches, lengths):.1%} "
+          f"({len(sampler)} batches), with batch size {batch_size}: {padding_ratio(fixed_batches, lengths):.1%} ({len(fixed_batches)} batches)")
+    return sampler
+
+#when max_residues is set, training batches are built by LengthBucketSampler from proteins of similar length
+#and hold up to max_residues padded residues, instead of batch_size proteins.
+#with packed=True the proteins of a batch are joined into one sequence instead of being padded.
+#loader_kwargs are DataLoader options from loader_options (worker processes, prefetching, pinned memory)
+#seed seeds the model initialisation, the shuffling and dropout, so a trial gives the same result wherever it runs.
+#pruner (e.g. a MedianPruner) can stop the trial before num_ep epochs when it is clearly worse than the finished trials.
+#with a checkpoint_dir the trial saves its best epoch there and resumes from its last epoch if it was interrupted.
+#fast=True trains in fast mode and then checks the trained model's accuracy against float32 with check_fast_mode.
+#prefetch loads batches ahead in a background thread, see train_loop. settings are added to the run settings a
+#checkpoint has to match to be resumed, max_residues and seed always are.
+#with folds set, the trial is scored by k-fold cross-validation instead, see train_evaluate_kfold
+def train_evaluate(parameterization, train_dataset, validation_dataset, num_ep, patience, trial_index, max_residues=None, packed=False, loader_kwargs=None, seed=None, pruner=None, checkpoint_dir=None, fast=False,
+                   metrics_log=None, timing=False, profile_steps=None, trace_path='trace_{trial}.json', folds=None, fold_workers=None, prefetch=None, settings=None):
+    if folds is not None:
+        return train_evaluate_kfold(parameterization, merge_splits(train_dataset, validation_dataset), folds, trial_index, fold_workers, seed, metrics_log,
+                                    num_ep=num_ep, patience=patience, max_residues=max_residues, packed=packed, loader_kwargs=loader_kwargs, pruner=pruner,
+                                    checkpoint_dir=checkpoint_dir, fast=fast, timing=timing, profile_steps=profile_steps, trace_path=trace_path, prefetch=prefetch)
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+    # Here, parameterization is a dict with hyperparameters
+    #set the hyperparameters
+    dropout_rate=parameterization["dropout_rate"]
+    model = build_model(parameterization)
+    lr=parameterization["lr"]
+    optimizer = torch.optim.Adam(model.parameters(), lr)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    batch_size = parameterization["batch_size"]
+    print(f"Now running with dropout rate: {dropout_rate}, lr:{lr}, batch size:{batch_size})")
+
+    #load the train dataset and validation dataset
+    loader_kwargs = loader_kwargs or loader_options()
+    train_loader = make_train_loader(train_dataset, batch_size, max_residues, collate_for(model, packed), loader_kwargs, seed or 0)
+    validation_loader = make_validation_loader(validation_dataset, batch_size, max_residues, collate_for(model, packed), loader_kwargs)
+
+    #get test loss, accuracy and trained model
+    avg_test_loss, accuracy, trained_model = train_loop(model, train_loader, validation_loader, optimizer, loss_fn, num_ep, patience, trial_index, packed, pruner, checkpoint_dir, parameterization, fast,
+                                                       metrics_log, timing, profile_steps, trace_path, prefetch,
+                                                       {'max_residues': max_residues, 'seed': seed, **(settings or {})}) # Assume this is computed during your training loop
+    if fast:
+        check_fast_mode(trained_model, validation_loader, loss_fn, packed)
+    return {"loss": (avg_test_loss, 0.0),"accuracy":(accuracy,0.0)}
+
+#compare the validation accuracy of fast mode (compiled, bfloat16 autocast) with the float32 model, and warn when the
+#difference is more than tolerance percentage points. returns both accuracies and whether fast mode is within tolerance
+def check_fast_mode(model, data_loader, loss_fn, packed=False, tolerance=0.5):
+    baseline, _ = val_pred(model, data_loader, loss_fn, packed)
+    fast, _ = val_pred(compile_model(model, training=False), data_loader, loss_fn, packed, fast=True)
+    within = abs(fast['accuracy'] - baseline['accuracy']) <= tolerance
+    print(f"Fast mode accuracy {fast['accuracy']:.4f}%, float32 accuracy {baseline['accuracy']:.4f}%"
+          + ('' if within else f", more than {tolerance} points apart"))
+    return baseline['accuracy'], fast['accuracy'], within
+
+#the train and validation split joined again for cross-validation. splits made by random_split from one dataset become a
+#single Subset of it, so the folds index the original dataset
+def merge_splits(train_dataset, validation_dataset):
+    if isinstance(train_dataset, Subset) and isinstance(validation_dataset, Subset) and train_dataset.dataset is validation_dataset.dataset:
+        return Subset(train_dataset.dataset, list(train_dataset.indices) + list(validation_dataset.indices))
+    return ConcatDataset([train_dataset, validation_dataset])
+
+#the validation indices of each of the folds, the same for every trial so their scores can be compared
+def fold_indices(n_proteins, folds, seed=0):
+    return np.array_split(np.random.default_rng(seed).permutation(n_proteins), folds)
+
+#train one fold in a worker process of train_evaluate_kfold. the fold runs as trial '<trial>_fold<fold>', which names
+#its checkpoints, and its epochs are sent back as records of the trial with a 'fold' key
+def run_fold(parameterization, dataset, validation_indices, fold, folds, trial_index, seed, train_kwargs):
+    validation = set(validation_indices.tolist())
+    train_indices = [i for i in range(len(dataset)) if i not in validation]
+    metrics_log = MetricsLog()
+    raw_data = train_evaluate(parameterization, Subset(dataset, train_indices), Subset(dataset, validation_indices.tolist()),
+                              trial_index=f'{trial_index}_fold{fold}', seed=seed, metrics_log=metrics_log,
+                              settings={'folds': folds, 'fold': fold}, **train_kwargs)
+    return fold, raw_data, [dict(record, trial=trial_index, fold=fold) for record in metrics_log.records]
+
+#k-fold cross-validation of a trial: the dataset is cut into folds parts and a model is trained on all but one part and
+#validated on that part, for every part. the folds are trained at the same time in fold_workers processes (folds by
+#default) with an equal share of this process's cpu threads. the workers get the dataset pickled, which leaves out the
+#memory maps of a store, so each reopens the same store files and they all read one copy through the page cache (without
+#a store every worker gets a copy of the cached proteins). fold f is seeded with seed * folds + f.
+#returns the mean and the standard error of the mean of the folds' last validation loss and accuracy for Ax. with a
+#checkpoint_dir, the best checkpoint of the most accurate fold is also saved as the trial's best checkpoint
+def train_evaluate_kfold(parameterization, dataset, folds, trial_index, fold_workers=None, seed=None, metrics_log=None, **train_kwargs):
+    #every fold needs proteins to train and to validate on, and the standard error needs two folds
+    if not 2 <= folds <= len(dataset):
+        raise ValueError(f'folds must be between 2 and the number of proteins ({len(dataset)}), got {folds}')
+    metrics_log = metrics_log if metrics_log is not None else MetricsLog()
+    fold_workers = fold_workers or folds
+    threads = max(1, torch.get_num_threads() // fold_workers)
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    results = {}
+    with ProcessPoolExecutor(fold_workers, mp_context=context, initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+        futures = [pool.submit(run_fold, parameterization, dataset, validation_indices, fold, folds, trial_index,
+                               None if seed is None else seed * folds + fold, train_kwargs)
+                   for fold, validation_indices in enumerate(fold_indices(len(dataset), folds))]
+        for future in futures:
+            fold, raw_data, records = future.result()
+            results[fold] = raw_data
+            metrics_log.extend(records)
+
+    summary = {}
+    for name in ('loss', 'accuracy'):
+        values = np.array([results[fold][name][0] for fold in sorted(results)])
+        summary[name] = (float(values.mean()), float(values.std(ddof=1) / np.sqrt(len(values))))
+    print(f"Trial {trial_index} {folds}-fold accuracy {summary['accuracy'][0]:.4f}% +- {summary['accuracy'][1]:.4f}")
+    checkpoint_dir = train_kwargs.get('checkpoint_dir')
+    if checkpoint_dir is not None:
+        best_fold = max(results, key=lambda fold: results[fold]['accuracy'][0])
+        shutil.copyfile(checkpoint_path(checkpoint_dir, f'{trial_index}_fold{best_fold}'), checkpoint_path(checkpoint_dir, trial_index))
+    return summary
+
+#train one trial in a worker process of run_trials_parallel. the epochs are logged in the worker and sent back together
+#with the result for Ax, the main process adds them to its log. cache is the TensorCache of the datasets (sent in the same
+#call, so it is still the one they use), its counts during the trial are sent back too
+def run_trial(parameterization, trial_index, seed, train_dataset, validation_dataset, train_kwargs, cache=None):
+    start = cache.counts() if cache is not None else None
+    metrics_log = MetricsLog()
+    raw_data = train_evaluate(parameterization, train_dataset, validation_dataset, trial_index=trial_index, seed=seed, metrics_log=metrics_log, **train_kwargs)
+    return trial_index, raw_data, metrics_log.records, cache.counts(since=start) if cache is not None else None
+
+#run num_trials trials of the Ax search at the same time in n_workers processes. Ax is asked for as many trials as there
+#are free workers, every trial is trained with train_evaluate in its own process with an equal share of the cpu threads,
+#and each trial is completed as soon as it finishes. trial i is seeded with base_seed + i, so results do not depend on
+#which worker ran the trial. train_kwargs are passed on to train_evaluate (num_ep, patience, max_residues, ...), a
+#pruner in train_kwargs is given every finished trial and sent with its current state to every new trial. the epochs of
+#every trial are added to metrics_log, and the cache hits of every trial to cache (the TensorCache of the datasets)
+def run_trials_parallel(ax_client, num_trials, train_dataset, validation_dataset, n_workers, base_seed=0, metrics_log=None, cache=None, **train_kwargs):
+    metrics_log = metrics_log if metrics_log is not None else MetricsLog()
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    #forked workers inherit the datasets and modules, spawned ones (Windows) import them again
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    running = {}
+    submitted = 0
+    with ProcessPoolExecutor(n_workers, mp_context=context, initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+        while submitted < num_trials or running:
+            #ask Ax for a batch of trials to fill the free workers
+            if submitted < num_trials and len(running) < n_workers:
+                trials, _ = ax_client.get_next_trials(max_trials=min(n_workers - len(running), num_trials - submitted))
+                for trial_index, parameters in trials.items():
+                    future = pool.submit(run_trial, parameters, trial_index, base_seed + trial_index,
+                                         train_dataset, validation_dataset, train_kwargs, cache)
+                    running[future] = trial_index
+                submitted += len(trials)
+                #Ax could not generate any trial and nothing is running that could change that
+                if not running:
+                    break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial_index = running.pop(future)
+                try:
+                    trial_index, raw_data, records, counts = future.result()
+                except Exception as error:
+                    print(f"Trial {trial_index} failed: {error}")
+                    ax_client.log_trial_failure(trial_index=trial_index)
+                    continue
+                ax_client.complete_trial(trial_index=trial_index, raw_data=raw_data)
+                metrics_log.extend(records)
+                if counts is not None:
+                    cache.add_counts(counts)
+                if train_kwargs.get('pruner') is not None:
+                    train_kwargs['pruner'].add_trial(trial_index, metrics_log.curve(trial_index, 'val_accuracy'))
+
+#print how many epochs the trials of a search trained, against the num_ep epochs per trial they could have used
+def log_search_epochs(metrics_log, num_ep):
+    val_accuracies = metrics_log.curves('val_accuracy')
+    spent = sum(len(accuracies) for accuracies in val_accuracies.values())
+    budget = num_ep * len(val_accuracies)
+    print(f"Search trained {spent} epochs of a budget of {budget} ({len(val_accuracies)} trials), {budget - spent} epochs saved")
+    return spent
+
+#compare the architectures of the trials of a search from their best checkpoints: weights, floating point operations
+#per residue, receptive field, cpu time per 1000 residues on the validation set and validation accuracy, cheapest first.
+#trials without a checkpoint (failed ones) are left out
+def variant_report(checkpoint_dir, trial_indices, validation_dataset, batch_size=32, packed=False, loader_kwargs=None):
+    loss_fn = torch.nn.CrossEntropyLoss()
+    rows = []
+    for trial_index in trial_indices:
+        if not os.path.exists(checkpoint_path(checkpoint_dir, trial_index)):
+            continue
+        model, checkpoint = load_trial_checkpoint(checkpoint_dir, trial_index)
+        loader = make_validation_loader(validation_dataset, batch_size, None, collate_for(model, packed), loader_kwargs or loader_options())
+        metrics, _, ms = timed_val_pred(model, loader, loss_fn, packed)
+        rows.append({'trial': trial_index,
+                     **{key: checkpoint['parameters'].get(key, default) for key, default in architecture_defaults.items()},
+                     'params': count_parameters(model), 'mflops_per_residue': flops_per_residue(model) / 1e6,
+                     'receptive_radius': receptive_radius(model), 'ms_per_1k_residues': ms, 'accuracy': metrics['accuracy']})
+    rows.sort(key=lambda row: row['mflops_per_residue'])
+    for row in rows:
+        print(f"trial {row['trial']}: width {row['width']}, depth {row['depth']}, kernel {row['kernel_size']}, "
+              f"separable {row['separable']}, dilation {row['dilation']} | {row['params']} params, "
+              f"{row['mflops_per_residue']:.3f} MFLOPs/residue, receptive radius {row['receptive_radius']}, "
+              f"{row['ms_per_1k_residues']:.2f} ms/1k residues, accuracy {row['accuracy']:.4f}%")
+    return rows